@@ -0,0 +1,68 @@
+"""Hive-partitioned Parquet dataset exchanged between the cleaning stages.
+
+Layout: <base_dir>/UNDERLYING=SPY/YEAR=2020/MATURITY_BUCKET=1/<basename>-0.parquet
+Rows are sorted by DATE inside each file so that row group statistics allow
+predicate pushdown on dates as well as on the partition keys.
+"""
+
+import glob
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+partition_schema = pa.schema([
+    ("UNDERLYING", pa.string()), ("YEAR", pa.int16()), ("MATURITY_BUCKET", pa.int8())])
+partitioning = ds.partitioning(partition_schema, flavor="hive")
+# partitions below UNDERLYING=<underlying>
+underlying_partitioning = ds.partitioning(pa.schema(list(partition_schema)[1:]), flavor="hive")
+
+def write_part(table:pa.Table, base_dir:str, underlying:str, basename:str,
+        row_group_size:int = 64 * 1024):
+    """Writes the rows coming from one raw file, partitioned by underlying, year and maturity bucket"""
+    date = table["DATE"]
+    table = (table
+        .append_column("UNDERLYING", pa.array([underlying] * table.num_rows, pa.string()))
+        .append_column("YEAR", pc.cast(pc.utf8_slice_codeunits(date, 0, 4), pa.int16()))
+        .set_column(table.schema.get_field_index("MATURITY_BUCKET"), "MATURITY_BUCKET",
+            pc.cast(table["MATURITY_BUCKET"], pa.int8()))
+        .sort_by([("DATE", "ascending"), ("MONEYNESS_BUCKET", "ascending")]))
+    ds.write_dataset(table, base_dir, format="parquet", partitioning=partitioning,
+        basename_template=basename + "-{i}.parquet", existing_data_behavior="overwrite_or_ignore",
+        max_rows_per_group=row_group_size, min_rows_per_group=min(row_group_size, 1024))
+
+def part_files(base_dir:str, underlying:str, basename:str) -> list:
+    """Files written by write_part for one raw file, in every partition"""
+    return glob.glob(os.path.join(base_dir, f"UNDERLYING={underlying}", "*", "*", basename + "-*.parquet"))
+
+def delete_part(base_dir:str, underlying:str, basename:str):
+    for f in part_files(base_dir, underlying, basename):
+        os.remove(f)
+
+def years(base_dir:str, underlying:str) -> list:
+    """YEAR partitions available for an underlying, in increasing order"""
+    folders = glob.glob(os.path.join(base_dir, f"UNDERLYING={underlying}", "YEAR=*"))
+    return sorted(int(os.path.basename(f).split("=")[1]) for f in folders)
+
+def dataset(base_dir:str, underlying:str) -> ds.Dataset:
+    """Dataset of one underlying, with YEAR and MATURITY_BUCKET as partition keys.
+    Only the UNDERLYING=<underlying> folder is listed and its files give the schema, so that the
+    parts of other underlyings, possibly being written, are never opened."""
+    return ds.dataset(os.path.join(base_dir, f"UNDERLYING={underlying}"), format="parquet",
+        partitioning=underlying_partitioning)
+
+def read_table(dataset:ds.Dataset, columns:list | None = None, filters=None) -> pa.Table:
+    """Reads only the requested columns and the row groups matching filters.
+
+    Args:
+        dataset (ds.Dataset): see dataset, built once and read by chunks
+        columns (list | None): columns to read, partition keys included. Defaults to all.
+        filters: pyarrow expression or DNF list of tuples, e.g. [("YEAR", "==", 2020), ("DATE", ">=", "20200301")]
+    """
+    if filters is not None and not isinstance(filters, ds.Expression):
+        filters = pq.filters_to_expression(filters)
+    return dataset.to_table(columns=columns, filter=filters)
+
+def read(dataset:ds.Dataset, columns:list | None = None, filters=None):
+    return read_table(dataset, columns, filters).to_pandas()
@@ -1,138 +1,261 @@
-import gc
+import os
+import sys
 import glob
+import shutil
+import json
+import hashlib
 import numpy as np
 import pandas as pd
 import pyarrow as pa
+import pyarrow.csv as pv
 from pathlib import Path
 import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
+import _dataset
 
-def main():
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from _instrument import stage, size
+
+initial_select_columns = [
+    "QUOTE_DATE", "EXPIRE_DATE", "P_IV", "P_LAST", "UNDERLYING_LAST", "STRIKE", "P_DELTA",
+]
+
+# On hold columns: "MISSING_STRIKE" "MISSING_UNDERLYING" "price_LT005"
+
+filter_remove_columns = [
+    "maturity_GT360", "maturity_LT7", "IV_LT005","IV_GT070", "MISSING_PRICE",
+    "MISSING_DELTA", "MISSING_DATE", "MISSING_MATURITY", "MISSING_IV", "is_DELTAinvalid"
+]
+
+checks_columns = [
+    "TOT", "maturity_GT360", "maturity_LT7", "IV_LT005","IV_GT070", "price_LT005",
+    "MISSING_DELTA", "MISSING_PRICE", "MISSING_DATE", "MISSING_MATURITY",
+    "MISSING_UNDERLYING", "MISSING_STRIKE", "MISSING_IV","is_DOTM", "is_OTM",
+    "is_ATM", "is_DATM","is_maturityLT45", "is_maturity_45_90", "is_maturity_90_180", "is_maturity_180",
+    "is_DELTAinvalid", "is_REMOVED", "is_NOT_REMOVED"
+]
+
+# Registry of named checks, each one a bit of the FLAGS column. New checks are appended here:
+# positions of existing flags must not change, at most 32 checks fit in the uint32 column.
+check_registry = {
+    "maturity_GT360": lambda x: x["MATURITY"] > 360.0,
+    "maturity_LT7": lambda x: x["MATURITY"] < 7.0,
+    "IV_LT005": lambda x: x["P_IV"] < 0.05,
+    "IV_GT070": lambda x: x["P_IV"] > 0.70,
+    "price_LT005": lambda x: x["P_LAST"] < 0.05,
+    "MISSING_DELTA": lambda x: x["P_DELTA"].isna(),
+    "MISSING_PRICE": lambda x: x["P_LAST"].isna(),
+    "MISSING_DATE": lambda x: x["DATE"].isna(),
+    "MISSING_MATURITY": lambda x: x["MATURITY"].isna(),
+    "MISSING_UNDERLYING": lambda x: x["UNDERLYING_LAST"].isna(),
+    "MISSING_STRIKE": lambda x: x["STRIKE"].isna(),
+    "MISSING_IV": lambda x: x["P_IV"].isna(),
+    "is_DOTM": lambda x: (-0.125 <= x["P_DELTA"]) & (0.0 > x["P_DELTA"]),
+    "is_OTM": lambda x: (-0.375 <= x["P_DELTA"]) & (-0.125 > x["P_DELTA"]),
+    "is_ATM": lambda x: (-0.5 <= x["P_DELTA"]) & (-0.375 > x["P_DELTA"]),
+    "is_DATM": lambda x: -0.5 > x["P_DELTA"],
+    "is_maturityLT45": lambda x: x["MATURITY"] <= 45.0,
+    "is_maturity_45_90": lambda x: (x["MATURITY"] > 45.0) & (x["MATURITY"] <= 90.0),
+    "is_maturity_90_180": lambda x: (x["MATURITY"] > 90.0) & (x["MATURITY"] <= 180.0),
+    "is_maturity_180": lambda x: x["MATURITY"] > 180.0,
+    "is_DELTAinvalid": lambda x: (-1.0 >= x["P_DELTA"]) | (0.0 <= x["P_DELTA"]),
+}
+flag_bits = {name: np.uint32(1 << i) for i, name in enumerate(check_registry)}
+remove_mask = np.bitwise_or.reduce([flag_bits[c] for c in filter_remove_columns])
+
+remove_columns = ["QUOTE_DATE", "EXPIRE_DATE", "FLAGS"]
+
+def _flags(x:pd.DataFrame) -> np.ndarray:
+    """Packs all registered checks in one uint32 array"""
+    flags = np.zeros(len(x), dtype=np.uint32)
+    for name, check in check_registry.items():
+        flags |= np.where(np.asarray(check(x), dtype=bool), flag_bits[name], np.uint32(0))
+    return flags
+
+def _unpack(flags:np.ndarray, names:list | None = None) -> pd.DataFrame:
+    """Boolean view of the FLAGS column, for inspection of single checks"""
+    if names is None: names = list(check_registry)
+    flags = np.asarray(flags, dtype=np.uint32)
+    return pd.DataFrame({n: np.bitwise_and(flags, flag_bits[n]) != 0 for n in names})
+
+def _summary(flags:np.ndarray) -> pd.Series:
+    """Counts of every check in checks_columns, one popcount per bit of the flags"""
+    flags = np.ascontiguousarray(flags, dtype=np.uint32)
+    bits = np.unpackbits(flags.view(np.uint8).reshape(-1, 4), axis=1, bitorder="little")
+    counts = bits.sum(axis=0, dtype=np.int64)
+    removed = np.count_nonzero(np.bitwise_and(flags, remove_mask))
+    out = {name: int(counts[int(bit).bit_length() - 1]) for name, bit in flag_bits.items()}
+    out |= {"TOT": flags.shape[0], "is_REMOVED": removed, "is_NOT_REMOVED": flags.shape[0] - removed}
+    return pd.Series(out)[checks_columns]
+
+def _read_raw(f:str) -> pd.DataFrame:
+    """Reads only initial_select_columns of an OptionsDX .txt file with the multithreaded pyarrow reader.
+    Column names are stripped of brackets and spaces from the header line, dates are kept as strings
+    and coerced later so that invalid entries become missing as with pd.read_csv.
+    """
+    with open(f, "r") as fh:
+        names = [c.strip().strip("[]") for c in fh.readline().split(",")]
+    missing = [c for c in initial_select_columns if c not in names]
+    if missing:
+        raise ValueError(f"{f}: missing columns after cleanup: {missing}")
+    column_types = {c: pa.float64() for c in initial_select_columns}
+    column_types["QUOTE_DATE"] = pa.string()
+    column_types["EXPIRE_DATE"] = pa.string()
+    table = pv.read_csv(f,
+        read_options=pv.ReadOptions(column_names=names, skip_rows=1, use_threads=True),
+        convert_options=pv.ConvertOptions(include_columns=initial_select_columns,
+            column_types=column_types, null_values=["", " "], strings_can_be_null=True))
+    return table.to_pandas()
+
+def _checks(merged:pd.DataFrame) -> pd.DataFrame:
+    """Adds buckets and the packed FLAGS column to the selected raw columns"""
+    quote_date = pd.to_datetime(merged["QUOTE_DATE"].str.strip(), errors="coerce")
+    expire_date = pd.to_datetime(merged["EXPIRE_DATE"].str.strip(), errors="coerce")
+
+    return merged.assign(
+        DATE=quote_date.dt.strftime("%Y%m%d"),
+        MATURITY=(expire_date - quote_date).dt.days,
+    ).assign(
+        MATURITY_BUCKET=lambda x: np.select([
+            x["MATURITY"] <= 45.0,
+            (x["MATURITY"] > 45.0) & (x["MATURITY"] <= 90.0),
+            (x["MATURITY"] > 90.0) & (x["MATURITY"] <= 180.0),
+            x["MATURITY"] > 180.0],
+            [1, 2, 3, 4],
+            default=np.nan
+        ),
+        MONEYNESS_BUCKET = lambda x: np.select(
+            [((-0.125 <= x["P_DELTA"]) & (0.0 > x["P_DELTA"])),
+            ((-0.375 <= x["P_DELTA"]) & (-0.125 > x["P_DELTA"])),
+            ((-0.5 <= x["P_DELTA"]) & (-0.375 > x["P_DELTA"])),
+            ((-0.5 > x["P_DELTA"]))],
+            [1, 2, 3, 4],
+            default=np.nan
+        ),
+        FLAGS = _flags
+    )
+
+def _file_hash(f:str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(f, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 24), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _version() -> str:
+    """Hash of the code of the checks (this module and _dataset) and of the registered and
+    removing checks: the parts written by another version are stale"""
+    h = hashlib.blake2b(digest_size=16)
+    for f in (__file__, _dataset.__file__):
+        h.update(_file_hash(f).encode())
+    h.update(json.dumps([list(check_registry), filter_remove_columns]).encode())
+    return h.hexdigest()
+
+def _process_file(f:str, underlying:str, filtered_dir:str, final_dir:str) -> dict:
+    """Parses one raw file and writes its own part of the checks and filtered datasets.
+    Returns the check sums so that totals can be rebuilt from the manifest."""
+    with stage("filter.file", file=f, bytes_read=os.path.getsize(f)) as rec:
+        put_filtered = _checks(_read_raw(f))
+        flags = put_filtered["FLAGS"].to_numpy()
+        put_final = put_filtered[np.bitwise_and(flags, remove_mask) == 0].drop(columns=remove_columns)
+        put_checks = _summary(flags)
+
+        part = Path(f).stem + ".parquet"
+        # diagnostics: only the flags and the row of the raw file, see _unpack
+        pq.write_table(pa.table({"ROW": np.arange(flags.shape[0], dtype=np.int32), "FLAGS": flags}),
+            os.path.join(filtered_dir, part), compression="zstd", use_dictionary=["FLAGS"],
+            column_encoding={"ROW": "DELTA_BINARY_PACKED"})
+        _dataset.delete_part(final_dir, underlying, Path(f).stem)
+        _dataset.write_part(pa.Table.from_pandas(put_final, preserve_index=False), final_dir, underlying, Path(f).stem)
+        rec |= {"rows_in": len(put_filtered), "rows_out": len(put_final),
+            "bytes_written": size(os.path.join(filtered_dir, part))
+                + sum(map(size, _dataset.part_files(final_dir, underlying, Path(f).stem)))}
+    return {"part": part, "checks": {k: int(v) for k, v in put_checks.items()}}
+
+def main(workers:int | None = None, incremental:bool = True, subfolder:str = "SPY"):
     """
         Following from Bollen and Whaley (2004), moneyness filters are created based on Delta
         to account for volatility.
         price_LT005 removes too many observations so it is kept in
         TODO: check relative frequency of excluded observations, group by year
         create new buckets for DATM
+
+        Each raw file is parsed in a process pool and written as its own part of the
+        checks.parquet dataset (ROW of the raw file and FLAGS) and of the filtered dataset shared by all underlyings, which is
+        hive-partitioned by UNDERLYING/YEAR/MATURITY_BUCKET (see _dataset).
+        manifest.json maps every raw file to its hash, part, check sums and the version of the
+        checks (see _version): with incremental=True only new or changed raw files and the files
+        processed by another version of the checks are processed, parts of deleted raw files are dropped.
+
+        subfolder: underlying, reads data/<subfolder>/raw/*.txt
     """
-    subfolder = "SPY"
+    with stage("filter", subfolder=subfolder, incremental=incremental) as rec:
+        _main(workers, incremental, subfolder, rec)
+
+def _main(workers:int | None, incremental:bool, subfolder:str, rec:dict):
     filtered_path = "data/" +subfolder+ "/put/checks.parquet"
-    final_path    = "data/" +subfolder+ "/put/filtered.parquet"
+    final_path    = "data/put/filtered"
     checks_path   = "data/" +subfolder+ "/put/checks/all.parquet"
+    manifest_path = "data/" +subfolder+ "/put/manifest.json"
+
+    files = sorted(glob.glob("data/" +subfolder+ "/raw/*.txt"))
+
+    for folder in (filtered_path, final_path, os.path.dirname(checks_path)):
+        if Path(folder).is_file(): Path(folder).unlink()
+        Path(folder).mkdir(parents=True, exist_ok=True)
+
+    manifest = {}
+    if incremental and os.path.exists(manifest_path):
+        with open(manifest_path, "r") as fh:
+            manifest = json.load(fh)
+    else:
+        # full rebuild: also the checks parts of raw files deleted since the last run
+        shutil.rmtree(os.path.join(final_path, "UNDERLYING=" + subfolder), ignore_errors=True)
+        shutil.rmtree(filtered_path, ignore_errors=True)
+        Path(filtered_path).mkdir(parents=True, exist_ok=True)
+
+    current = {Path(f).stem: f for f in files}
+    for stem in set(manifest) - set(current):
+        Path(filtered_path, manifest[stem]["part"]).unlink(missing_ok=True)
+        _dataset.delete_part(final_path, subfolder, stem)
+        del manifest[stem]
+
+    version = _version()
+    todo = {}
+    for stem, f in current.items():
+        stat = os.stat(f)
+        entry = manifest.get(stem)
+        valid = (entry is not None and entry.get("version") == version
+            and Path(filtered_path, entry["part"]).exists())
+        if valid and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            continue
+        digest = _file_hash(f)
+        if valid and entry["hash"] == digest:
+            entry["size"], entry["mtime_ns"] = stat.st_size, stat.st_mtime_ns
+            continue
+        todo[stem] = {"hash": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "version": version}
+
+    rec |= {"files": len(files), "processed": len(todo), "bytes_read": sum(todo[s]["size"] for s in todo)}
+    if workers == 1:
+        results = (_process_file(current[stem], subfolder, filtered_path, final_path) for stem in todo)
+        for stem, res in zip(todo, results):
+            manifest[stem] = todo[stem] | res
+    elif todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {stem: pool.submit(_process_file, current[stem], subfolder, filtered_path, final_path) for stem in todo}
+            for stem, fut in futures.items():
+                manifest[stem] = todo[stem] | fut.result()
+
+    with open(manifest_path, "w") as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
 
-    files = glob.glob("data/" +subfolder+ "/raw/*.txt")
-
-    Path("data/" +subfolder+ "/put/").mkdir(parents=True, exist_ok=True)
-
-    filtered_writer = None
-    final_writer = None
-    put_checks_sum = None
-
-    initial_select_columns = [
-        "QUOTE_DATE", "EXPIRE_DATE", "P_IV", "P_LAST", "UNDERLYING_LAST", "STRIKE", "P_DELTA", 
-    ]
-
-    # On hold columns: "MISSING_STRIKE" "MISSING_UNDERLYING" "price_LT005"
-
-    filter_remove_columns = [
-        "maturity_GT360", "maturity_LT7", "IV_LT005","IV_GT070", "MISSING_PRICE",
-        "MISSING_DELTA", "MISSING_DATE", "MISSING_MATURITY", "MISSING_IV", "is_DELTAinvalid"
-    ]
-
-    checks_columns = [
-        "TOT", "maturity_GT360", "maturity_LT7", "IV_LT005","IV_GT070", "price_LT005",
-        "MISSING_DELTA", "MISSING_PRICE", "MISSING_DATE", "MISSING_MATURITY",
-        "MISSING_UNDERLYING", "MISSING_STRIKE", "MISSING_IV","is_DOTM", "is_OTM", 
-        "is_ATM", "is_DATM","is_maturityLT45", "is_maturity_45_90", "is_maturity_90_180", "is_maturity_180",
-        "is_DELTAinvalid", "is_REMOVED", "is_NOT_REMOVED"
-    ]
-
-    remove_columns =  list(set(checks_columns) | set(filter_remove_columns) |
-        set(["QUOTE_DATE", "EXPIRE_DATE"]))
-
-    for f in files:
-        merged = pd.read_csv(f, sep=",", skipinitialspace=True)
-        merged.columns = merged.columns.str.replace(r"[\[\]]", "", regex=True)
-
-        missing = [c for c in initial_select_columns if c not in merged.columns]
-        if missing:
-            raise ValueError(f"{f}: missing columns after cleanup: {missing}")
-
-        merged = merged[initial_select_columns]
-
-        merged.columns = merged.columns.str.replace(r"[\[\]]", "", regex=True)
-        quote_date = pd.to_datetime(merged["QUOTE_DATE"], errors="coerce")
-        expire_date = pd.to_datetime(merged["EXPIRE_DATE"], errors="coerce")
-
-        put_filtered = merged.assign(
-            DATE=quote_date.dt.strftime("%Y%m%d"),
-            MATURITY=(expire_date - quote_date).dt.days,
-        ).assign(
-            TOT = 1,
-            MATURITY_BUCKET=lambda x: np.select([
-                x["MATURITY"] <= 45.0,
-                (x["MATURITY"] > 45.0) & (x["MATURITY"] <= 90.0),
-                (x["MATURITY"] > 90.0) & (x["MATURITY"] <= 180.0),
-                x["MATURITY"] > 180.0],
-                [1, 2, 3, 4],
-                default=np.nan
-            ),
-            is_maturityLT45 = lambda x: x["MATURITY"] <= 45.0,
-            is_maturity_45_90= lambda x: (x["MATURITY"] > 45.0) & (x["MATURITY"] <= 90.0),
-            is_maturity_90_180= lambda x:(x["MATURITY"] > 90.0) & (x["MATURITY"] <= 180.0),
-            is_maturity_180= lambda x: x["MATURITY"] > 180.0,
-            MONEYNESS_BUCKET = lambda x: np.select(
-                [((-0.125 <= x["P_DELTA"]) & (0.0 > x["P_DELTA"])),
-                ((-0.375 <= x["P_DELTA"]) & (-0.125 > x["P_DELTA"])),
-                ((-0.5 <= x["P_DELTA"]) & (-0.375 > x["P_DELTA"])),
-                ((-0.5 > x["P_DELTA"]))],
-                [1, 2, 3, 4],
-                default=np.nan
-            ),
-            is_DOTM=lambda x: ((-0.125 <= x["P_DELTA"]) & (0.0 > x["P_DELTA"])),
-            is_OTM=lambda x: ((-0.375 <= x["P_DELTA"]) & (-0.125 > x["P_DELTA"])),
-            is_ATM=lambda x: ((-0.5 <= x["P_DELTA"]) & (-0.375 > x["P_DELTA"])),
-            is_DATM=lambda x: ((-0.5 > x["P_DELTA"])),
-            is_DELTAinvalid = lambda x: ((-1.0 >= x["P_DELTA"]) | (0.0 <= x["P_DELTA"])),
-            maturity_GT360=lambda x: (x["MATURITY"] > 360.0),
-            maturity_LT7=lambda x: (x["MATURITY"] < 7.0),
-            IV_LT005=lambda x: (x["P_IV"] < 0.05),
-            IV_GT070=lambda x: (x["P_IV"] > 0.70),
-            price_LT005 = lambda x: (x["P_LAST"] < 0.05),
-            MISSING_DELTA=lambda x: x["P_DELTA"].isna(),
-            MISSING_PRICE=lambda x: x["P_LAST"].isna(),
-            MISSING_DATE=lambda x: x["DATE"].isna(),
-            MISSING_MATURITY=lambda x: x["MATURITY"].isna(),
-            MISSING_UNDERLYING=lambda x: x["UNDERLYING_LAST"].isna(),
-            MISSING_STRIKE=lambda x: x["STRIKE"].isna(),
-            MISSING_IV=lambda x: x["P_IV"].isna()
-        ).assign(
-            is_REMOVED = lambda x: x[filter_remove_columns].any(axis=1),
-            is_NOT_REMOVED = lambda x: ~x[filter_remove_columns].any(axis=1)
-        )
-        put_final = put_filtered[(put_filtered[filter_remove_columns] == 0).all(axis=1)
-            ].drop(columns=remove_columns)
-        put_checks = put_filtered[checks_columns].sum()
-        if put_checks_sum is None: put_checks_sum = put_checks
-        else: put_checks_sum = put_checks_sum.add(put_checks, fill_value=0)
-
-        table_filtered = pa.Table.from_pandas(put_filtered, preserve_index=False)
-        if filtered_writer is None:
-            filtered_writer = pq.ParquetWriter(filtered_path, table_filtered.schema)
-        filtered_writer.write_table(table_filtered)
-
-        table_final = pa.Table.from_pandas(put_final, preserve_index=False)
-        if final_writer is None:
-            final_writer = pq.ParquetWriter(final_path, table_final.schema)
-        final_writer.write_table(table_final)
-
-        del merged, quote_date, expire_date, put_filtered, put_final, put_checks, table_filtered, table_final
-        gc.collect()
-
-    if filtered_writer is not None: filtered_writer.close()
-    if final_writer is not None: final_writer.close()
-
-    put_checks = put_checks_sum.to_frame(name="value").T
+    put_checks_sum = pd.Series(0, index=checks_columns, dtype="int64")
+    for entry in manifest.values():
+        put_checks_sum = put_checks_sum.add(pd.Series(entry["checks"]), fill_value=0)
+    put_checks = put_checks_sum[checks_columns].to_frame(name="value").T
+    rec |= {"rows_in": sum(manifest[s]["checks"]["TOT"] for s in todo),
+        "rows_out": sum(manifest[s]["checks"]["is_NOT_REMOVED"] for s in todo)}
     put_checks.to_parquet(checks_path)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,8 +1,13 @@
 import gc
+import os
+import sys
 from pathlib import Path
 import pandas as pd
 
-def main():
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from _instrument import stage, size
+
+def main(subfolder:str = "SPY"):
     """For all .parquet files in data/put/ directory and not subfolders,
         creates a .csv copy of the first 20 observations in data/pu/head/ with the same name
     .parquet is convenient for storing high volume data, but not quick to directly open to see the structure of 
@@ -10,7 +15,6 @@ def main():
 
     Once the head is stored, the full file is removed from memory.
     """
-    subfolder = "SPY"
     folder = Path("data/"+subfolder+"/put/")
     out_dir = folder / "head"
     out_dir.mkdir(parents=True, exist_ok=True)
@@ -20,13 +24,16 @@ def main():
         if csv_path.exists():
             continue
 
-        try:
-            df_head = pd.read_parquet(parquet_path, engine="pyarrow").head(20).copy()
-        except Exception as e:
-            print(f"SKIP (read error): {parquet_path.name} -> {e}")
-            continue
+        with stage("head_builder.file", file=str(parquet_path)) as rec:
+            try:
+                df_head = pd.read_parquet(parquet_path, engine="pyarrow").head(20).copy()
+            except Exception as e:
+                print(f"SKIP (read error): {parquet_path.name} -> {e}")
+                rec["skipped"] = str(e)
+                continue
 
-        df_head.to_csv(csv_path, index=False)
+            df_head.to_csv(csv_path, index=False)
+            rec |= {"bytes_read": size(str(parquet_path)), "bytes_written": size(str(csv_path))}
 
         del df_head
         gc.collect()
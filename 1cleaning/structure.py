@@ -1,22 +1,20 @@
+import os
+import sys
 import numpy as np
 import pandas as pd
-import gc
+import pyarrow as pa
+import pyarrow.parquet as pq
+import _dataset
 
-def main():
-    """Creates factors for the models and creates bucketed data.
-    TODO: create additional factors in X, add calls, explicitly treat missing in treat
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from _instrument import stage, size
 
-    Closeness is defined by the summed squared distance 
-    for both delta and maturity, where we put ten times
-    more weight on delta because the smaller values compared to maturity.
+joint_buckets = [f"mat{i}_mon{j}" for i in range(1, 5) for j in range(1, 5)]
+group_columns = ["DATE", "MATURITY_BUCKET", "MONEYNESS_BUCKET"]
+feature_columns = ["logIV", "level", "moneyness", "moneyness2", "maturity", "interaction"]
 
-    From:
-    van der Wel, M., Ozturk, S.R. and van Dijk, D.J.C. (2015).
-    Dynamic Factor Models for the Volatility Surface. 
-    SSRN Electronic Journal. doi:https://doi.org/10.2139/ssrn.2558018.
-    """
-    subfolder = "SPY"
-    data = pd.read_parquet("data/"+ subfolder +"/put/filtered.parquet")
+def _features(data:pd.DataFrame, dummies:bool = True) -> pd.DataFrame:
+    """Model factors, bucket midpoints and closeness of every quote"""
     data = data.assign(
         logIV = np.log((data["P_IV"]).to_numpy()),
         level = 1.0,
@@ -27,9 +25,9 @@ def main():
             x["MATURITY_BUCKET"] == 2,
             x["MATURITY_BUCKET"] == 3,
             x["MATURITY_BUCKET"] == 4],
-            [(7.0 + 45.0) / 2.0, 
-            (45.0 + 90.0) / 2.0, 
-            (90.0 + 180.0) / 2.0, 
+            [(7.0 + 45.0) / 2.0,
+            (45.0 + 90.0) / 2.0,
+            (90.0 + 180.0) / 2.0,
             (180.0 + 360.0) / 2.0],
             default=np.nan),
         delta_midpoint = lambda x: np.select([
@@ -42,34 +40,109 @@ def main():
             (-0.5 + -0.375) / 2.0,
             (-1.0 + -0.5) / 2.0],
             default=np.nan),
-        joint_bucket = "mat" + data["MATURITY_BUCKET"].astype("int").astype("string") + "_mon" + data["MONEYNESS_BUCKET"].astype("int").astype("string")
+        joint_bucket = pd.Categorical("mat" + data["MATURITY_BUCKET"].astype("int").astype("string")
+            + "_mon" + data["MONEYNESS_BUCKET"].astype("int").astype("string"), categories=joint_buckets)
         ).assign(
         moneyness2 = lambda x: x["moneyness"]**2,
         interaction = lambda x: x["moneyness"] * x["maturity"],
         closeness = lambda x: (
             10.0 * (x["delta_midpoint"] - x["P_DELTA"])**2 + (x["maturity_midpoint"]-x["MATURITY"])))
+    if not dummies: return data
+    # fixed categories keep the same dummy columns in every chunk, the ones of buckets that never
+    # occur are all zero and dropped by models._design.load
     bj_dummies = pd.get_dummies(data["joint_bucket"], prefix="bucket", drop_first=True)
-    data = data.join(bj_dummies)
-    bjcol_list = bj_dummies.columns.tolist()
+    return data.join(bj_dummies)
+
+def _representatives(data:pd.DataFrame) -> pd.DataFrame:
+    """Quote with the smallest closeness for every (DATE, MATURITY_BUCKET, MONEYNESS_BUCKET).
+    Grouped argmin, ties go to the first row in the current order."""
+    best = data.groupby(group_columns, sort=False)["closeness"].idxmin()
+    return data.loc[best.dropna().to_numpy()].sort_values(group_columns, ignore_index=True)
+
+def _compact(data:pd.DataFrame) -> pd.DataFrame:
+    """Compact model table: int32 YYYYMMDD dates, float32 features and the joint bucket
+    as a dictionary-encoded code instead of dense dummy columns (see models._design)"""
+    out = {"DATE": data["DATE"].astype("int32")}
+    out |= {c: data[c].astype("float32") for c in feature_columns}
+    out["joint_bucket"] = data["joint_bucket"]
+    return pd.DataFrame(out)
+
+def _append(writer:pq.ParquetWriter | None, path:str, df:pd.DataFrame,
+        row_group_size:int | None = None) -> pq.ParquetWriter:
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if writer is None:
+        writer = pq.ParquetWriter(path, table.schema)
+    writer.write_table(table, row_group_size=row_group_size)
+    return writer
+
+def main(filters:list | None = None, compact:bool = False, subfolder:str = "SPY"):
+    """Creates factors for the models and creates bucketed data.
+    TODO: create additional factors in X, add calls, explicitly treat missing in treat
+
+    Closeness is defined by the summed squared distance
+    for both delta and maturity, where we put ten times
+    more weight on delta because the smaller values compared to maturity.
+
+    From:
+    van der Wel, M., Ozturk, S.R. and van Dijk, D.J.C. (2015).
+    Dynamic Factor Models for the Volatility Surface.
+    SSRN Electronic Journal. doi:https://doi.org/10.2139/ssrn.2558018.
+
+    filters: additional predicates pushed down to the filtered dataset, e.g. [("YEAR", "==", 2020)]
+    so that only the matching partitions and row groups are read.
+
+    The filtered dataset is processed one YEAR partition at a time: no date spans two partitions,
+    so the representative of each bucket is a grouped argmin within the chunk and memory is
+    bounded by one year of quotes of one underlying.
+
+    compact: writes full.parquet and bucket.parquet with the compact schema of _compact.
+    subfolder: underlying, writes to data/<subfolder>/put/
+    """
+    with stage("structure", subfolder=subfolder, compact=compact) as rec:
+        _main(filters, compact, subfolder, rec)
+
+def _main(filters:list | None, compact:bool, subfolder:str, rec:dict):
+    base_dir = "data/put/filtered"
+    out_dir = "data/"+ subfolder +"/put/"
+    columns = ["DATE", "P_IV", "STRIKE", "UNDERLYING_LAST", "MATURITY", "P_DELTA",
+        "MATURITY_BUCKET", "MONEYNESS_BUCKET"]
     model_columns = ["DATE", "logIV", "level", "moneyness", "moneyness2", "maturity", "interaction"]
-    model_columns = model_columns + bjcol_list
-    full_model = data[model_columns]
-    full_model.to_parquet("data/"+ subfolder +"/put/full.parquet")
-    del full_model
-    gc.collect()
-    
-    data = (data
-    .sort_values("closeness").groupby(["DATE", "MATURITY_BUCKET", "MONEYNESS_BUCKET"], as_index=False)
-    .first().sort_values(["DATE", "MATURITY_BUCKET", "MONEYNESS_BUCKET"])
-    )
-    logiv_matrix = (data
-    .pivot(index="DATE", columns="joint_bucket", values="logIV")
-    .sort_index(axis=0).sort_index(axis=1))
-    logiv_matrix.to_parquet("data/"+ subfolder +"/put/bucket_matrix.parquet")
-    del logiv_matrix
-    gc.collect()
-    data = data[model_columns]
-    data.to_parquet("data/"+ subfolder +"/put/bucket.parquet")
+    model_columns = model_columns + ["bucket_" + b for b in joint_buckets[1:]]
+    _model = _compact if compact else lambda x: x[model_columns]
+
+    full_writer = None
+    bucket_writer = None
+    matrices = []
+    rec |= {"rows_in": 0, "rows_out": 0, "bytes_read": size(os.path.join(base_dir, "UNDERLYING=" + subfolder))}
+    years = _dataset.years(base_dir, subfolder)
+    dataset = _dataset.dataset(base_dir, subfolder) if years else None
+    for year in years:
+        with stage("structure.year", year=year) as year_rec:
+            data = _dataset.read(dataset, columns=columns, filters=[("YEAR", "==", year)] + (filters or []))
+            if data.empty: continue
+            data = _features(data.sort_values(group_columns, ignore_index=True), dummies=not compact)
+            full_writer = _append(full_writer, out_dir + "full.parquet", _model(data), 64 * 1024)
+            year_rec["rows_in"] = len(data)
+
+            data = _representatives(data)
+            matrices.append(data.pivot(index="DATE", columns="joint_bucket", values="logIV"))
+            bucket_writer = _append(bucket_writer, out_dir + "bucket.parquet", _model(data))
+            year_rec["rows_out"] = len(data)
+            rec["rows_in"] += year_rec["rows_in"]
+            rec["rows_out"] += year_rec["rows_out"]
+            del data
+
+    if not matrices:
+        raise ValueError(f"no filtered quotes of {subfolder} in {base_dir} match the filters {filters}")
+    full_writer.close()
+    bucket_writer.close()
+
+    logiv_matrix = pd.concat(matrices).sort_index(axis=0)
+    logiv_matrix = logiv_matrix.loc[:, logiv_matrix.notna().any(axis=0)]
+    logiv_matrix.columns = pd.Index(logiv_matrix.columns.astype(str), name="joint_bucket")
+    logiv_matrix = logiv_matrix.sort_index(axis=1)
+    logiv_matrix.to_parquet(out_dir + "bucket_matrix.parquet")
+    rec["bytes_written"] = sum(size(out_dir + f) for f in ("full.parquet", "bucket.parquet", "bucket_matrix.parquet"))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
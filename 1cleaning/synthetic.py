@@ -0,0 +1,152 @@
+"""Synthetic end of day option chains in the OptionsDX .txt format, for testing the
+cleaning stages without the real downloads.
+
+One file per month (<underlying>_eod_YYYYMM.txt) with the bracketed header and the
+", " separated rows of OptionsDX, missing values written as a blank. The underlying follows
+a geometric Brownian motion, implied volatilities a skewed smile with a term structure
+and noise, prices and greeks come from Black-Scholes.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr
+
+columns = [
+    "QUOTE_UNIXTIME", "QUOTE_READTIME", "QUOTE_DATE", "QUOTE_TIME_HOURS", "UNDERLYING_LAST",
+    "EXPIRE_DATE", "EXPIRE_UNIX", "DTE", "C_DELTA", "C_GAMMA", "C_VEGA", "C_THETA", "C_RHO",
+    "C_IV", "C_VOLUME", "C_LAST", "C_SIZE", "C_BID", "C_ASK", "STRIKE", "P_BID", "P_ASK",
+    "P_SIZE", "P_LAST", "P_DELTA", "P_GAMMA", "P_VEGA", "P_THETA", "P_RHO", "P_IV", "P_VOLUME",
+    "STRIKE_DISTANCE", "STRIKE_DISTANCE_PCT",
+]
+header = ", ".join("[" + c + "]" for c in columns)
+
+def _day(rng:np.random.Generator, date:pd.Timestamp, spot:float, strikes:int, expiries:int,
+        missing_rate:float, invalid_rate:float) -> pd.DataFrame:
+    """Chain of one quote date, strikes x expiries rows"""
+    dte = np.unique(np.round(np.geomspace(1, 720, expiries)))
+    expire = date + pd.to_timedelta(dte, unit="D")
+    K = np.round(spot * np.linspace(0.5, 1.3, strikes))
+    dte_r, K_r = np.repeat(dte, K.shape[0]), np.tile(K, dte.shape[0])
+    tau = dte_r / 365.0
+    log_m = np.log(K_r / spot)
+    iv = (0.18 - 0.25 * log_m + 0.4 * log_m**2 + 0.03 * np.exp(-tau)) * np.exp(0.05 * rng.standard_normal(K_r.shape[0]))
+    iv = np.clip(iv, 0.02, 3.0)
+    d1 = (-log_m + (0.02 + 0.5 * iv**2) * tau) / (iv * np.sqrt(tau))
+    d2 = d1 - iv * np.sqrt(tau)
+    disc = np.exp(-0.02 * tau)
+    call = spot * ndtr(d1) - K_r * disc * ndtr(d2)
+    put = K_r * disc * ndtr(-d2) - spot * ndtr(-d1)
+    pdf = np.exp(-0.5 * d1**2) / np.sqrt(2.0 * np.pi)
+    gamma = pdf / (spot * iv * np.sqrt(tau))
+    vega = spot * pdf * np.sqrt(tau) / 100.0
+    theta = -spot * pdf * iv / (2.0 * np.sqrt(tau)) / 365.0
+    n = K_r.shape[0]
+    spread = 0.01 + 0.02 * call
+    pspread = 0.01 + 0.02 * put
+    unix = int(date.timestamp()) + 16 * 3600
+    out = pd.DataFrame({
+        "QUOTE_UNIXTIME": np.full(n, f" {unix}", dtype=object),
+        "QUOTE_READTIME": np.full(n, f" {date:%Y-%m-%d} 16:00", dtype=object),
+        "QUOTE_DATE": np.full(n, f" {date:%Y-%m-%d}", dtype=object),
+        "QUOTE_TIME_HOURS": 16.0,
+        "UNDERLYING_LAST": spot,
+        "EXPIRE_DATE": np.repeat(np.array([f" {d:%Y-%m-%d}" for d in expire], dtype=object), K.shape[0]),
+        "EXPIRE_UNIX": np.repeat(np.array([f" {int(d.timestamp()) + 16 * 3600}" for d in expire], dtype=object), K.shape[0]),
+        "DTE": dte_r,
+        "C_DELTA": ndtr(d1), "C_GAMMA": gamma, "C_VEGA": vega, "C_THETA": theta,
+        "C_RHO": K_r * tau * disc * ndtr(d2) / 100.0, "C_IV": iv,
+        "C_VOLUME": rng.poisson(50, n).astype(float), "C_LAST": call, "C_SIZE": rng.poisson(10, n).astype(float),
+        "C_BID": np.maximum(call - spread, 0.0), "C_ASK": call + spread,
+        "STRIKE": K_r,
+        "P_BID": np.maximum(put - pspread, 0.0), "P_ASK": put + pspread, "P_SIZE": rng.poisson(10, n).astype(float),
+        "P_LAST": put, "P_DELTA": ndtr(d1) - 1.0, "P_GAMMA": gamma, "P_VEGA": vega, "P_THETA": theta,
+        "P_RHO": -K_r * tau * disc * ndtr(-d2) / 100.0, "P_IV": iv,
+        "P_VOLUME": rng.poisson(50, n).astype(float),
+        "STRIKE_DISTANCE": np.abs(K_r - spot), "STRIKE_DISTANCE_PCT": np.abs(K_r / spot - 1.0),
+    })
+    # blanks as in the raw files, on the columns used by the cleaning
+    for c in ("P_IV", "P_DELTA", "P_LAST", "UNDERLYING_LAST", "STRIKE"):
+        out.loc[rng.random(n) < missing_rate, c] = np.nan
+    # values the checks have to catch: delta outside (-1, 0), negative IV and prices, bad dates
+    bad = rng.random(n) < invalid_rate
+    out.loc[bad, "P_DELTA"] = rng.choice([0.5, -1.5], bad.sum())
+    bad = rng.random(n) < invalid_rate
+    out.loc[bad, "P_IV"] = -out.loc[bad, "P_IV"]
+    bad = rng.random(n) < invalid_rate
+    out.loc[bad, "P_LAST"] = -1.0
+    bad = rng.random(n) < invalid_rate / 10.0
+    out.loc[bad, "EXPIRE_DATE"] = " 0000-00-00"
+    return out
+
+def write_month(path:str, seed:np.random.SeedSequence, dates:pd.DatetimeIndex, spots:np.ndarray,
+        strikes:int = 100, expiries:int = 20, missing_rate:float = 0.01,
+        invalid_rate:float = 0.005) -> int:
+    """Writes the chains of the quote dates of one month, one day at a time, returns the number of rows"""
+    rng = np.random.default_rng(seed)
+    rows = 0
+    with open(path, "w") as fh:
+        fh.write(header + "\n")
+        for date, spot in zip(dates, spots):
+            chain = _day(rng, date, spot, strikes, expiries, missing_rate, invalid_rate)
+            chain.to_csv(fh, header=False, index=False, float_format=" %.4f", na_rep=" ",
+                lineterminator="\n")
+            rows += chain.shape[0]
+    return rows
+
+def generate(out_dir:str, underlying:str = "spy", start:str = "2020-01", months:int | None = 12,
+        size_gb:float | None = None, strikes:int = 100, expiries:int = 20,
+        missing_rate:float = 0.01, invalid_rate:float = 0.005, seed:int = 0,
+        workers:int | None = 1) -> dict:
+    """
+    Writes monthly files from start on, for the given number of months or for about size_gb
+    of raw files (the number of months is extrapolated from the size of the first one).
+    The path of the underlying is drawn here and every month has its own seed, so that the
+    files are the same for any number of workers.
+
+    Args:
+        out_dir (str): e.g. data/SPY/raw
+        strikes, expiries (int): chain size, one row per (strike, expiry) and quote date
+        missing_rate (float): share of blanks in each of P_IV, P_DELTA, P_LAST, UNDERLYING_LAST and STRIKE
+        invalid_rate (float): share of invalid deltas, IVs and prices
+        workers (int | None): processes writing the months, 1 writes them in this process
+    Returns:
+        dict with files, rows and bytes written
+    """
+    if months is None and size_gb is None:
+        raise ValueError("one of months and size_gb is needed")
+    os.makedirs(out_dir, exist_ok=True)
+    seeds = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seeds.spawn(1)[0])
+    period = pd.Period(start, freq="M")
+    spot = 300.0
+
+    def jobs(n:int):
+        nonlocal period, spot
+        for _ in range(n):
+            dates = pd.bdate_range(period.start_time, period.end_time.normalize())
+            spots = np.round(spot * np.exp(np.cumsum(0.01 * rng.standard_normal(dates.shape[0]))), 2)
+            spot = spots[-1]
+            path = os.path.join(out_dir, f"{underlying}_eod_{period.year}{period.month:02d}.txt")
+            period += 1
+            yield (path, seeds.spawn(1)[0], dates, spots, strikes, expiries, missing_rate, invalid_rate)
+
+    out = {"files": [], "rows": 0, "bytes": 0}
+    def collect(path:str, rows:int):
+        out["files"].append(path)
+        out["rows"] += rows
+        out["bytes"] += os.path.getsize(path)
+
+    first = next(jobs(1))
+    collect(first[0], write_month(*first))
+    if months is None:
+        months = max(int(np.ceil(size_gb * 1e9 / out["bytes"])), 1)
+    rest = list(jobs(months - 1))
+    if workers == 1:
+        for job in rest: collect(job[0], write_month(*job))
+        return out
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for job, fut in [(job, pool.submit(write_month, *job)) for job in rest]:
+            collect(job[0], fut.result())
+    return out
@@ -1,70 +1,133 @@
-from univariate_scaling import moment_scaling
+import univariate_scaling
+from univariate_scaling import scaling
+import hashlib
+import json
+import os
+import sys
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from scipy.special import gamma
 import matplotlib.pyplot as plt
 from matplotlib.ticker import FixedLocator, FixedFormatter
 
-def main():
-    """
-    Computes realized power variation and scaling
-    exponent from daily observations to 6 months
-    """
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from _instrument import stage
 
-    subfolder = "SPY"
-    data = pd.read_parquet("data/" + subfolder + "/put/bucket_matrix.parquet")
-    print(f"nans in dataset {np.sum(data.isna().to_numpy())}")
+moments = np.arange(1, 9) / 2
+tick_days = np.array([1, 5, 21, 63, 116])
+tick_labels = ["", "1 week", "1 month", "3 months", "6 months"]
 
-    moments = np.arange(1, 9) / 2
-    tick_days = np.array([1, 5, 21, 63, 116])
-    tick_labels = ["", "1 week", "1 month", "3 months", "6 months"]
-    
-    scalings = {}
+def _cache_key(path:str, params:dict) -> str:
+    """Hash of the input file, of the parameters of the computation and of the source of the
+    modules computing it, so that a code change does not serve stale results"""
+    h = hashlib.blake2b(digest_size=16)
+    for f in (path, __file__, univariate_scaling.__file__):
+        with open(f, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1 << 24), b""):
+                h.update(chunk)
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
 
-    for label in data.columns:
-        column = data[label]
-        scaling_dict = moment_scaling(column, 1.0, 126.0, moments)
-        dt = scaling_dict["delta_ts"]
+def compute(subfolder:str, columns:list | None = None, filters:list | None = None,
+        minf:float = 1.0, maxf:float = 126.0, cache:bool = True) -> dict:
+    """Scaling of every bucket of bucket_matrix, stored in data/<subfolder>/put/scaling/<key>.npz
+    where key hashes the input file, the arguments and the source of the computation, so that
+    a run with the same inputs and code loads the stored result instead of recomputing it.
 
-        for x in tick_days:
-            plt.axvline(x, linestyle="--", linewidth=0.8, color="black")
+    Returns:
+        dict with labels, moments and the output of univariate_scaling.scaling
+    """
+    path = "data/" + subfolder + "/put/bucket_matrix.parquet"
+    params = {"columns": columns, "filters": filters, "minf": minf, "maxf": maxf,
+        "moments": moments.tolist()}
+    with stage("scaling.compute", subfolder=subfolder, bytes_read=os.path.getsize(path)) as rec:
+        cache_path = "data/" + subfolder + "/put/scaling/" + _cache_key(path, params) + ".npz"
+        rec["cache_hit"] = cache and os.path.exists(cache_path)
+        if rec["cache_hit"]:
+            with np.load(cache_path) as f:
+                return {k: f[k] for k in f.files}
 
-        ax = plt.gca()
-        ax.xaxis.set_major_locator(FixedLocator(tick_days))
-        ax.xaxis.set_major_formatter(FixedFormatter(tick_labels))
-        holder = []
-        for q in moments:
-            holder.append(scaling_dict[q]["holder"])
-            y = scaling_dict[q]["shifted_power_var"]
-            line, = plt.plot(dt, y)
-            plt.text(
-                dt[-1]*1.01,
-                y[-1],
-                f"q={q}",
-                color=line.get_color(),
-                va="center",
-                fontsize=9)
-            
-        plt.ylabel(r"$S(q, \Delta t)$")
-        plt.xlabel(r"$\Delta t$")
-        plt.xlim((dt[0], dt[-1]+15))
-        plt.xticks(rotation=0, ha="right")
-        plt.savefig("plot/" + subfolder + "/put/scaling" + label + ".pdf")
-        plt.close()
+        data = pd.read_parquet(path, columns=columns, filters=filters)
+        print(f"nans in dataset {np.sum(data.isna().to_numpy())}")
+        # all buckets and moments in one pass
+        result = scaling(data.to_numpy(), minf, maxf, moments)
+        result |= {"labels": np.array(data.columns, dtype=str), "moments": moments}
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        np.savez(cache_path, **result)
+        rec |= {"rows_in": data.shape[0], "columns": data.shape[1],
+            "bytes_written": os.path.getsize(cache_path)}
+    return result
+
+def _render_bucket(label:str, dt:np.ndarray, shifted_power_var:np.ndarray, path:str):
+    for x in tick_days:
+        plt.axvline(x, linestyle="--", linewidth=0.8, color="black")
+
+    ax = plt.gca()
+    ax.xaxis.set_major_locator(FixedLocator(tick_days))
+    ax.xaxis.set_major_formatter(FixedFormatter(tick_labels))
+    for i, q in enumerate(moments):
+        y = shifted_power_var[i]
+        line, = plt.plot(dt, y)
+        plt.text(
+            dt[-1]*1.01,
+            y[-1],
+            f"q={q}",
+            color=line.get_color(),
+            va="center",
+            fontsize=9)
+
+    plt.ylabel(r"$S(q, \Delta t)$")
+    plt.xlabel(r"$\Delta t$")
+    plt.xlim((dt[0], dt[-1]+15))
+    plt.xticks(rotation=0, ha="right")
+    plt.savefig(path)
+    plt.close()
 
-        scalings[label] = np.array(holder)
-    
+def _render_moments(labels:np.ndarray, holder:np.ndarray, path:str):
     holder_bm = moments / 2.0 - 1.0
     plt.figure()
     plt.plot(moments, holder_bm, color="black", linestyle="--")
-    for label in scalings.keys():
-        plt.plot(moments, scalings[label])
+    for j, _ in enumerate(labels):
+        plt.plot(moments, holder[j])
     plt.ylabel(r"$\tau(q)$")
     plt.xlabel(r"$q$")
     plt.xlim((moments[0], moments[-1]))
     plt.ylim((None, 1.0))
-    plt.savefig("plot/" + subfolder + "/put/moments" + "_scaling_"+".pdf")
+    plt.savefig(path)
     plt.close()
 
+def render(result:dict, subfolder:str, workers:int | None = None):
+    """One figure per bucket and the moment scaling figure, rendered in a process pool"""
+    out_dir = "plot/" + subfolder + "/put/"
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = [(_render_bucket, label, result["delta_ts"], result["shifted_power_var"][j],
+        out_dir + "scaling" + label + ".pdf") for j, label in enumerate(result["labels"])]
+    jobs.append((_render_moments, result["labels"], result["holder"],
+        out_dir + "moments" + "_scaling_" + ".pdf"))
+    with stage("scaling.render", subfolder=subfolder, figures=len(jobs)):
+        if workers == 1:
+            for f, *args in jobs: f(*args)
+            return
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for fut in [pool.submit(*job) for job in jobs]:
+                fut.result()
+
+def main(columns:list | None = None, filters:list | None = None, workers:int | None = None,
+        cache:bool = True, subfolder:str = "SPY"):
+    """
+    Computes realized power variation and scaling
+    exponent from daily observations to 6 months
+
+    columns: buckets to read, defaults to all
+    filters: predicates on DATE pushed down to the parquet reader, e.g. [("DATE", ">=", "20200101")]
+    workers: processes rendering the figures, 1 renders them in this process
+    cache: reuses the stored scaling of the same input and arguments, see compute
+    subfolder: underlying, reads data/<subfolder>/put/bucket_matrix.parquet
+    """
+
+    result = compute(subfolder, columns, filters, cache=cache)
+    render(result, subfolder, workers)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,49 +1,81 @@
 import numpy as np
 
-def _partition(x: np.ndarray, delta_t: int) -> np.ndarray:
-    """Given an array and a partition length size, reshapes the array in a 
-    matrix such that each row is a partition of such length. 
-    If the array is not reshapeable in such size, additional 0 entries are added. """
-    T = int(x.shape[0])
-    delta_t = int(delta_t)
-    N = (T + delta_t - 1) // delta_t
-    pad = N * delta_t - T
-    x_pad = np.pad(x, (0, pad), mode="constant", constant_values=0)
-    return x_pad.reshape((N, delta_t))
+def _disjoint_power_variation(X: np.ndarray, delta_t: int, qs: np.ndarray) -> np.ndarray:
+    """Sum of |x_{(i+1) delta_t} - x_{i delta_t}|^q over the disjoint blocks of length delta_t,
+    for every column of X (T, ncol) and moment q. NaN increments are skipped. Returns (nq, ncol)"""
+    coarse_inc = np.abs(np.diff(X[::int(delta_t)], axis=0))
+    return np.nansum(coarse_inc[None] ** qs[:, None, None], axis=1)
 
-def _expected_power_variation(x_spaced: np.ndarray, q: float) -> float:
-    coarse_inc = x_spaced[1:, 0] - x_spaced[:-1, 0]
-    return np.nansum(np.abs(coarse_inc) ** q)
+def _overlapping_power_variation(X: np.ndarray, delta_t: int, qs: np.ndarray) -> np.ndarray:
+    """Power variation from the overlapping increments x_{t + delta_t} - x_t of every t, taken as a
+    strided difference of two views of X. The mean over the non-NaN increments is scaled by
+    (T - delta_t) / delta_t, the number of disjoint increments, so that the result estimates the
+    same quantity as _disjoint_power_variation with lower variance. Returns (nq, ncol)"""
+    delta_t = int(delta_t)
+    T = X.shape[0]
+    inc = np.abs(X[delta_t:] - X[:-delta_t])
+    total = np.nansum(inc[None] ** qs[:, None, None], axis=1)
+    count = np.sum(~np.isnan(inc), axis=0)
+    mean = np.divide(total, count, out=np.full(total.shape, np.nan), where=count > 0)
+    return mean * max(T - delta_t, 0) / delta_t
 
 def _make_time_lags(minf, maxf, factor=1.1) -> np.ndarray:
     n = (np.log(maxf) - np.log(minf)) / np.log(factor)
     return np.unique(
         np.round(minf * factor ** np.arange(int(np.floor(n)) + 1)).astype(int))
 
-def moment_scaling(x, minf, maxf, qs:np.ndarray, factor = 1.1)->dict:
-    out = {}
+def scaling(X, minf, maxf, qs:np.ndarray, factor = 1.1, overlapping:bool = False) -> dict:
+    """Power variations and scaling exponents of all the columns of X and all the moments in qs.
+
+    The coarse increments are computed once per lag for all the columns, the moments are
+    broadcast over them and the log-log regressions of every (column, q) are one least squares
+    problem with a shared design [1, log delta_t].
+
+    Args:
+        X: (T,) or (T, ncol) series, e.g. bucket_matrix
+        qs (np.ndarray): moments
+        overlapping (bool): power variations from all the overlapping increments of every lag
+            (_overlapping_power_variation) instead of the disjoint blocks
+    Returns:
+        dict with delta_ts, log_t and the (ncol, nq, nlags) log_power_var and shifted_power_var,
+        (ncol, nq) intercept and holder
+    """
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1: X = X[:, None]
+    qs = np.asarray(qs, dtype=float)
     delta_ts = _make_time_lags(minf, maxf, factor=factor)
     log_t = np.log(delta_ts)
-    for q in qs:
-        power_var = np.empty_like(delta_ts, dtype=float)
-        for i,dt in enumerate(delta_ts):
-            x_part = _partition(x,dt)
-            power_var[i] = _expected_power_variation(x_part, q)
-        log_power_var = np.log(power_var)
-        bad = ~np.isfinite(power_var)
-        if np.any(bad):
-            print("bad power_var at q=", q, "delta_ts=", delta_ts[bad], "raw=", power_var[bad])
-
-        lt = log_t - log_t.mean()
-        lp = log_power_var - log_power_var.mean()
-        holder = np.sum(lt * lp) / np.sum(lt**2)
-        intercept = log_power_var.mean() - holder * log_t.mean()
+    power_variation = _overlapping_power_variation if overlapping else _disjoint_power_variation
+    power_var = np.stack([power_variation(X, dt, qs) for dt in delta_ts], axis=-1)
+    log_power_var = np.log(power_var).transpose(1, 0, 2)
+    ncol, nq, nlags = log_power_var.shape
+    design = np.column_stack([np.ones(nlags), log_t])
+    # the pseudo-inverse keeps a non-finite series from spreading to the other columns
+    coef = np.linalg.pinv(design) @ log_power_var.reshape(-1, nlags).T
+    intercept, holder = coef.reshape(2, ncol, nq)
+    return {
+        "delta_ts": delta_ts,
+        "log_t": log_t,
+        "log_power_var": log_power_var,
+        "shifted_power_var": log_power_var - intercept[:, :, None],
+        "intercept": intercept,
+        "holder": holder}
 
+def moment_scaling(x, minf, maxf, qs:np.ndarray, factor = 1.1, overlapping:bool = False)->dict:
+    """Scaling of a single series, by moment, see scaling"""
+    res = scaling(np.asarray(x, dtype=float), minf, maxf, qs, factor=factor, overlapping=overlapping)
+    delta_ts = res["delta_ts"]
+    out = {}
+    for j, q in enumerate(qs):
+        log_power_var = res["log_power_var"][0, j]
+        bad = ~np.isfinite(log_power_var)
+        if np.any(bad):
+            print("bad power_var at q=", q, "delta_ts=", delta_ts[bad], "raw=", np.exp(log_power_var[bad]))
         out[q] = {
                 "log_power_var": log_power_var,
-                "shifted_power_var": log_power_var - intercept,
-                "intercept": intercept,
-                "holder": holder}
+                "shifted_power_var": res["shifted_power_var"][0, j],
+                "intercept": res["intercept"][0, j],
+                "holder": res["holder"][0, j]}
     out["delta_ts"] = delta_ts
-    out["log_t"] = log_t
-    return out
\ No newline at end of file
+    out["log_t"] = res["log_t"]
+    return out
@@ -0,0 +1,31 @@
+"""Backend selection, numpy by default.
+
+The backend is chosen with the VS_BACKEND environment variable ("numpy" or "jax") or
+set_backend, and can be overridden per call with the backend argument of the filters.
+Every backend module exposes name, xp (array namespace), scan, cho_solve, jit, value_and_grad
+and to_numpy.
+"""
+
+import os
+import importlib
+
+_modules = {"numpy": "_backend._np", "jax": "_backend._jax"}
+_current = os.environ.get("VS_BACKEND", "numpy")
+
+def set_backend(name:str):
+    global _current
+    if name not in _modules:
+        raise ValueError(f"backend must be one of {list(_modules)}, got {name}")
+    _current = name
+
+def get_backend(name:str | None = None):
+    name = _current if name is None else name
+    if name not in _modules:
+        raise ValueError(f"backend must be one of {list(_modules)}, got {name}")
+    return importlib.import_module(_modules[name])
+
+def namespace(x):
+    """jax.numpy for JAX arrays and tracers, numpy otherwise"""
+    if type(x).__module__.startswith("jax"):
+        return get_backend("jax").xp
+    return get_backend("numpy").xp
@@ -0,0 +1,27 @@
+"""JAX backend: jax.numpy, lax.scan, jit and autodiff, computations in float64 on CPU"""
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from jax import lax
+from jax.scipy.linalg import cho_solve as _cho_solve
+
+jax.config.update("jax_enable_x64", True)
+
+name = "jax"
+xp = jnp
+
+def jax_scan(f, carry, xs):
+    """lax.scan with the same call signature as numpy_scan"""
+    return lax.scan(f, carry, xs)
+
+scan = jax_scan
+
+def cho_solve(c, b):
+    """Solves A x = b from the lower Cholesky factor c of A"""
+    return _cho_solve((c, True), b)
+jit = jax.jit
+value_and_grad = jax.value_and_grad
+
+def to_numpy(tree):
+    return jax.tree_util.tree_map(lambda x: np.asarray(x) if isinstance(x, jax.Array) else x, tree)
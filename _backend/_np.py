@@ -1,6 +1,7 @@
 """Generates Backend classes to make the code work for both numpy and JAX"""
 
 import numpy as np
+from scipy.linalg import cho_solve as _cho_solve
 
 def numpy_scan(f, carry, xs):
     """
@@ -9,8 +10,10 @@ def numpy_scan(f, carry, xs):
     - each leaf must keep the same shape/dtype across iterations
     - different leaves may have different shapes/dtypes
     - returns ys with a leading time dimension stacked per-leaf
+    - y = None stores nothing and returns ys = None
+    - xs can be a tuple of arrays with the same leading dimension, f gets the tuple of their slices
     """
-    T = xs.shape[0]
+    T = xs[0].shape[0] if isinstance(xs, tuple) else xs.shape[0]
     if T == 0: return carry, None
     def _alloc_like(y0):
         if isinstance(y0, dict): return {k: _alloc_like(v) for k, v in y0.items()}
@@ -34,11 +37,29 @@ def numpy_scan(f, carry, xs):
         if np.isscalar(y) or isinstance(y, np.generic):
             out[i] = y
         else: out[i, ...] = y
-    it = iter(xs)
+    it = zip(*xs) if isinstance(xs, tuple) else iter(xs)
     carry, y0 = f(carry, next(it))
+    if y0 is None:
+        for x in it: carry, _ = f(carry, x)
+        return carry, None
     ys = _alloc_like(y0)
     _write(ys, 0, y0)
     for i, x in enumerate(it, start=1):
         carry, y = f(carry, x)
         _write(ys, i, y)
-    return carry, ys
\ No newline at end of file
+    return carry, ys
+
+name = "numpy"
+xp = np
+scan = numpy_scan
+
+def cho_solve(c, b):
+    """Solves A x = b from the lower Cholesky factor c of A"""
+    return _cho_solve((c, True), b)
+value_and_grad = None
+
+def jit(f, **kwargs):
+    return f
+
+def to_numpy(tree):
+    return tree
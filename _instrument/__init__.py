@@ -0,0 +1,117 @@
+"""Structured instrumentation of the pipeline stages and of the estimation loops, off by default.
+
+VS_INSTRUMENT enables it: a file path appends one JSON object per line to that file (also from
+the workers of the process pools), "-" writes the lines to stderr.
+VS_PROFILE adds profiles to the outermost stage of every process, a comma separated list of
+    cprofile: cProfile stats dumped to <VS_PROFILE_DIR>/<stage>-<pid>-<n>.prof (default directory "."),
+        n counting the profiles of the process
+    tracemalloc: peak of the Python allocations of the stage, traced_peak_mb
+
+A stage record holds name, parent stage, pid, end time, seconds, peak RSS of the process so far
+and the fields set by the caller on the yielded dict (rows_in, rows_out, bytes_read,
+bytes_written, steps, ...), with seconds_per_step when steps is set:
+
+    with stage("filter.file", file=f) as rec:
+        ...
+        rec["rows_in"] = n
+"""
+
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# (name, pid) of the open stages, the workers of a forked pool inherit the stages of the parent
+_stack = []
+_profile_count = 0
+
+def enabled() -> bool:
+    return bool(os.environ.get("VS_INSTRUMENT"))
+
+def _profiles() -> set:
+    return {p.strip() for p in os.environ.get("VS_PROFILE", "").split(",") if p.strip()}
+
+def emit(event:str, **fields):
+    """Writes one JSON line, a no-op when instrumentation is disabled"""
+    target = os.environ.get("VS_INSTRUMENT")
+    if not target: return
+    line = json.dumps({"event": event, "pid": os.getpid(), "time": time.time()} | fields,
+        default=str) + "\n"
+    if target == "-":
+        sys.stderr.write(line)
+        return
+    # a single write of an O_APPEND file keeps the lines of concurrent processes whole
+    with open(target, "a") as fh:
+        fh.write(line)
+
+def size(path:str) -> int:
+    """Bytes of a file or of all the files under a directory, 0 if missing"""
+    if os.path.isfile(path): return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+@contextmanager
+def stage(name:str, **fields):
+    """Times the block and emits its record on exit, also when it raises"""
+    record = dict(fields)
+    if not enabled():
+        yield record
+        return
+    pid = os.getpid()
+    outermost = all(p != pid for _, p in _stack)
+    profiles = _profiles() if outermost else set()
+    profiler = cProfile.Profile() if "cprofile" in profiles else None
+    if profiler is not None:
+        try:
+            profiler.enable()
+        except ValueError:
+            # profiler of the parent still registered in a forked worker
+            profiler = None
+    trace = "tracemalloc" in profiles and not tracemalloc.is_tracing()
+    if trace: tracemalloc.start()
+    parent = _stack[-1][0] if _stack else None
+    _stack.append((name, pid))
+    status = "ok"
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        if profiler is not None: profiler.disable()
+        seconds = time.perf_counter() - start
+        _stack.pop()
+        out = {"stage": name, "parent": parent, "status": status, "seconds": seconds,
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+        if trace:
+            out["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        if profiler is not None:
+            global _profile_count
+            _profile_count += 1
+            folder = os.environ.get("VS_PROFILE_DIR", ".")
+            os.makedirs(folder, exist_ok=True)
+            out["profile"] = os.path.join(folder, f"{name}-{pid}-{_profile_count}.prof")
+            profiler.dump_stats(out["profile"])
+        out |= record
+        if record.get("steps"):
+            out["seconds_per_step"] = seconds / record["steps"]
+        emit("stage", **out)
+
+def iterations(name:str):
+    """scipy.optimize.minimize callback emitting the objective and the elapsed time of every
+    iteration, None when instrumentation is disabled"""
+    if not enabled(): return None
+    start = time.perf_counter()
+    count = 0
+    def callback(intermediate_result):
+        nonlocal count
+        count += 1
+        emit("iteration", stage=name, iteration=count, fun=float(intermediate_result.fun),
+            seconds=time.perf_counter() - start)
+    return callback
@@ -0,0 +1,90 @@
+"""Throughput of the cleaning pipeline (1cleaning/filter.py then structure.py) on synthetic
+OptionsDX files of a given size, written by 1cleaning/synthetic.py.
+
+Run from the repository root:
+
+    python -m benchmarks.ingestion --size-gb 1
+    python -m benchmarks.ingestion --size-gb 50 --workdir /scratch/ingestion --keep
+
+The stages read and write relative data/ paths, so they run as subprocesses in a work
+directory holding data/SPY/raw. Every stage records its wall time, rows/s and MB/s of raw
+input and its peak resident memory, the largest among the stage and the pool workers it
+waited for (rusage of os.wait4).
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(root, "1cleaning"))
+import synthetic
+
+stages = {
+    "filter": "import filter; filter.main(workers={workers}, incremental=False)",
+    "structure": "import structure; structure.main()",
+}
+
+def _run_stage(code:str, workdir:str) -> dict:
+    """Runs code with 1cleaning importable in workdir, wall time and peak RSS in MB"""
+    env = os.environ | {"PYTHONPATH": os.path.join(root, "1cleaning")}
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-c", code], cwd=workdir, env=env)
+    _, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, code)
+    # ru_maxrss is in kilobytes on Linux
+    return {"seconds": seconds, "peak_rss_mb": usage.ru_maxrss / 1024.0}
+
+def main(size_gb:float = 1.0, workdir:str | None = None, workers:int | None = None,
+        strikes:int = 100, expiries:int = 20, keep:bool = False,
+        output:str = "benchmarks/ingestion.json") -> dict:
+    """
+    Generates about size_gb of raw files in workdir (a temporary directory by default,
+    removed at the end unless keep) and times the stages on them.
+    """
+    tmp = workdir is None
+    workdir = tempfile.mkdtemp(prefix="ingestion_") if tmp else workdir
+    try:
+        start = time.perf_counter()
+        raw = synthetic.generate(os.path.join(workdir, "data", "SPY", "raw"), months=None,
+            size_gb=size_gb, strikes=strikes, expiries=expiries, workers=workers)
+        results = {"generate": {"seconds": time.perf_counter() - start}}
+        for name, code in stages.items():
+            results[name] = _run_stage(code.format(workers=workers), workdir)
+        for res in results.values():
+            res["rows_per_s"] = raw["rows"] / res["seconds"]
+            res["mb_per_s"] = raw["bytes"] / 1e6 / res["seconds"]
+    finally:
+        if tmp and not keep: shutil.rmtree(workdir, ignore_errors=True)
+    out = {"machine": platform.platform(), "python": platform.python_version(),
+        "cpus": os.cpu_count(), "workers": workers, "files": len(raw["files"]),
+        "rows": raw["rows"], "gb": raw["bytes"] / 1e9, "stages": results}
+    for name, res in results.items():
+        print(f"{name:10s} {res['seconds']:9.2f}s {res['rows_per_s']:12.0f} rows/s "
+            f"{res['mb_per_s']:8.1f} MB/s " + (f"{res['peak_rss_mb']:8.0f} MB peak" if "peak_rss_mb" in res else ""))
+    if output is not None:
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as fh:
+            json.dump(out, fh, indent=1)
+    return out
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-gb", type=float, default=1.0, help="approximate size of the raw files")
+    parser.add_argument("--workdir", default=None, help="defaults to a temporary directory")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--strikes", type=int, default=100)
+    parser.add_argument("--expiries", type=int, default=20)
+    parser.add_argument("--keep", action="store_true", help="keeps the temporary work directory")
+    parser.add_argument("--output", default="benchmarks/ingestion.json")
+    args = parser.parse_args()
+    main(args.size_gb, args.workdir, args.workers, args.strikes, args.expiries, args.keep, args.output)
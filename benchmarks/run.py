@@ -0,0 +1,179 @@
+"""Benchmarks of the estimation and scaling hot paths on synthetic inputs.
+
+Run from the repository root:
+
+    python -m benchmarks.run --T 1000 --p 16 --k 6
+    python -m benchmarks.run --save-baseline            # stores benchmarks/baseline.json
+    python -m benchmarks.run --baseline benchmarks/baseline.json --tolerance 0.2
+
+Every benchmark records the best wall time over the repetitions, the peak memory traced by
+tracemalloc in one extra run and a throughput (filter steps/s, likelihood evaluations/s or
+lags/s). With a baseline, a benchmark slower than (1 + tolerance) times its baseline is a
+regression and the exit code is 1.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "2holder_est"))
+from _backend._np import numpy_scan
+from models import ss, gas_gaussian
+from models._kalman import _filter, _fit
+from univariate_scaling import moment_scaling, scaling
+
+def _ss_inputs(T:int, p:int, k:int, seed:int = 0) -> tuple:
+    """Panel simulated from the state space model of models.ss with 5% missing IVs"""
+    rng = np.random.default_rng(seed)
+    covariates = rng.normal(size=(T * p, k))
+    covariates[:, 0] = 1.0
+    params = {"B": 0.9 * np.eye(k), "bar_beta": rng.normal(size=k), "Q_param": 0.01 * np.eye(k),
+        "H_param": np.diag(rng.uniform(0.01, 0.05, p)), "covariates": covariates}
+    beta = params["bar_beta"].copy()
+    data = np.empty((T, p))
+    for t in range(T):
+        data[t] = covariates[t * p:(t + 1) * p] @ beta + 0.1 * rng.normal(size=p)
+        beta = params["bar_beta"] + params["B"] @ (beta - params["bar_beta"]) + 0.1 * rng.normal(size=k)
+    data[rng.random(data.shape) < 0.05] = np.nan
+    return data, covariates, params
+
+def bench_numpy_scan(T:int, p:int, k:int) -> tuple:
+    x = np.random.default_rng(0).normal(size=(T, k))
+    f = lambda c, xt: (0.9 * c + xt, c)
+    return lambda: numpy_scan(f, np.zeros(k), x), T, "steps/s"
+
+def bench_kalman_filter(T:int, p:int, k:int) -> tuple:
+    data, _, params = _ss_inputs(T, p, k)
+    carry0 = ss._carry0(k, p)
+    return lambda: _filter(data, ss._dynamics, params, carry0, output="loglik"), T, "steps/s"
+
+def bench_kalman_filter_full(T:int, p:int, k:int) -> tuple:
+    data, _, params = _ss_inputs(T, p, k)
+    carry0 = ss._carry0(k, p)
+    return lambda: _filter(data, ss._dynamics, params, carry0, output="full"), T, "steps/s"
+
+def bench_kalman_fit(T:int, p:int, k:int, maxiter:int = 5) -> tuple:
+    """BFGS iterations with the analytic score, as ss.fit"""
+    data, covariates, params = _ss_inputs(T, p, k)
+    carry0 = ss._carry0(k, p)
+    initial_guess = ss._initial_guess(data, covariates)
+    evaluations = []
+    def link(x):
+        evaluations.append(1)
+        return ss._link(x, k, p) | {"covariates": covariates}
+    jac = lambda x, params, kf: ss._score(x, params, kf, carry0, data)
+    def run():
+        evaluations.clear()
+        _fit(data, dict(initial_guess), covariates, carry0, ss._dynamics, link, ss._invlink,
+            {"maxiter": maxiter}, jac=jac)
+        return len(evaluations)
+    return run, None, "evaluations/s"
+
+def bench_gas_filter(T:int, p:int, k:int) -> tuple:
+    """p quotes per date"""
+    rng = np.random.default_rng(0)
+    M = rng.normal(size=(T * p, k))
+    logIV = rng.normal(size=T * p)
+    offsets = np.arange(0, T * p + 1, p)
+    params = {"B": 0.9 * np.eye(k), "bar_beta": np.zeros(k), "C": 0.01 * np.eye(k), "h": np.array([0.02])}
+    return lambda: gas_gaussian._filter(logIV, M, offsets, params), T, "steps/s"
+
+def bench_moment_scaling(T:int, p:int, k:int) -> tuple:
+    x = np.cumsum(np.random.default_rng(0).normal(size=T))
+    qs = np.arange(1, 9) / 2
+    return lambda: moment_scaling(x, 1.0, min(126.0, T / 4), qs), T, "dates/s"
+
+def bench_scaling_panel(T:int, p:int, k:int) -> tuple:
+    X = np.cumsum(np.random.default_rng(0).normal(size=(T, p)), axis=0)
+    qs = np.arange(1, 9) / 2
+    return lambda: scaling(X, 1.0, min(126.0, T / 4), qs), T * p, "dates/s"
+
+benchmarks = {
+    "numpy_scan": bench_numpy_scan,
+    "kalman_filter": bench_kalman_filter,
+    "kalman_filter_full": bench_kalman_filter_full,
+    "kalman_fit": bench_kalman_fit,
+    "gas_filter": bench_gas_filter,
+    "moment_scaling": bench_moment_scaling,
+    "scaling_panel": bench_scaling_panel,
+}
+
+def _measure(run:callable, work:int | None, repeat:int) -> dict:
+    """Best wall time over repeat runs, peak traced memory of one more run. work is the amount
+    of work of one run, or None when run returns it"""
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = run()
+        times.append(time.perf_counter() - t)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    best = min(times)
+    work = out if work is None else work
+    return {"time_s": best, "peak_mb": peak / 1e6, "throughput": work / best}
+
+def compare(results:dict, baseline:dict, tolerance:float) -> dict:
+    """Ratio of the times to the baseline, for the benchmarks slower than 1 + tolerance"""
+    regressions = {}
+    for name, res in results["results"].items():
+        ref = baseline["results"].get(name)
+        if ref is None: continue
+        ratio = res["time_s"] / ref["time_s"]
+        flag = "REGRESSION" if ratio > 1.0 + tolerance else ""
+        print(f"{name:20s} {res['time_s']:10.4f}s  baseline {ref['time_s']:10.4f}s  x{ratio:5.2f} {flag}")
+        if flag: regressions[name] = ratio
+    return regressions
+
+def main(T:int = 500, p:int = 16, k:int = 6, repeat:int = 3, only:list | None = None,
+        output:str = "benchmarks/results.json", baseline:str | None = None,
+        tolerance:float = 0.2, save_baseline:bool = False) -> dict:
+    config = {"T": T, "p": p, "k": k, "repeat": repeat}
+    results = {"meta": {"python": platform.python_version(), "numpy": np.__version__,
+        "machine": platform.machine(), "processor": platform.processor(), "config": config},
+        "results": {}}
+    for name, bench in benchmarks.items():
+        if only is not None and name not in only: continue
+        run, work, unit = bench(T, p, k)
+        res = _measure(run, work, repeat) | {"unit": unit}
+        results["results"][name] = res
+        print(f"{name:20s} {res['time_s']:10.4f}s {res['peak_mb']:10.2f}MB {res['throughput']:14.1f} {unit}")
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as fh:
+        json.dump(results, fh, indent=1)
+    if save_baseline:
+        with open("benchmarks/baseline.json", "w") as fh:
+            json.dump(results, fh, indent=1)
+    regressions = {}
+    if baseline is not None:
+        with open(baseline) as fh:
+            ref = json.load(fh)
+        if ref["meta"]["config"] != config:
+            print(f"baseline config {ref['meta']['config']} differs from {config}")
+        regressions = compare(results, ref, tolerance)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--T", type=int, default=500, help="number of dates")
+    parser.add_argument("--p", type=int, default=16, help="cross-section width")
+    parser.add_argument("--k", type=int, default=6, help="state dimension")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="*", choices=list(benchmarks), default=None)
+    parser.add_argument("--output", default="benchmarks/results.json")
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+    regressions = main(args.T, args.p, args.k, args.repeat, args.only, args.output,
+        args.baseline, args.tolerance, args.save_baseline)
+    sys.exit(1 if regressions else 0)
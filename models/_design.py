@@ -0,0 +1,86 @@
+"""Loading of the design matrix M written by 1cleaning/structure.py.
+
+Works with both schemas of full.parquet and bucket.parquet: the dense one with
+bucket_* dummy columns and the compact one (int32 DATE, float32 features and a
+dictionary-encoded joint_bucket), whose dummies are built as a sparse block
+straight from the bucket codes.
+
+The numeric columns are read as views of the Arrow buffers (one copy when a column has nulls
+or several chunks), and the CSR arrays of M are written in a single pass from those views
+and the bucket codes, without an intermediate dense or COO matrix.
+"""
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import scipy.sparse as sp
+
+def _column(table:pa.Table, name:str) -> np.ndarray:
+    """Zero-copy view of a numeric column without nulls stored in one chunk"""
+    column = table.column(name)
+    if column.null_count > 0 or pa.types.is_boolean(column.type):
+        return column.combine_chunks().to_numpy(zero_copy_only=False)
+    chunks = [c.to_numpy(zero_copy_only=True) for c in column.chunks]
+    if len(chunks) == 1: return chunks[0]
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=column.type.to_pandas_dtype())
+
+def _csr(features:list, codes:np.ndarray, ncat:int) -> sp.csr_matrix:
+    """[features, dummies with the first category dropped] as CSR: the features are stored in
+    every row, followed by one entry for the rows with code > 0"""
+    n, nf = codes.shape[0], len(features)
+    dtype = np.result_type(*features) if features else np.float32
+    data = np.empty((n, nf + 1), dtype=dtype)
+    indices = np.empty((n, nf + 1), dtype=np.int32)
+    for j, x in enumerate(features):
+        data[:, j] = x
+        indices[:, j] = j
+    data[:, nf] = 1.0
+    indices[:, nf] = nf + codes - 1
+    stored = np.ones((n, nf + 1), dtype=bool)
+    stored[:, nf] = codes > 0
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(stored.sum(axis=1), out=indptr[1:])
+    return sp.csr_matrix((data[stored], indices[stored], indptr), shape=(n, nf + max(ncat - 1, 0)))
+
+def _observed_dummies(M:np.ndarray, dummy:list) -> np.ndarray:
+    """Columns of M to keep: the dummies of the buckets that never occur are all zero, and when
+    the base bucket (first category) never occurs the first remaining dummy becomes the base,
+    as get_dummies(drop_first=True) on the observed buckets"""
+    dummy = np.asarray(dummy, dtype=bool)
+    keep = ~dummy | (M != 0).any(axis=0)
+    if dummy.any() and not (M[:, dummy] == 0).all(axis=1).any():
+        keep[np.flatnonzero(keep & dummy)[:1]] = False
+    return keep
+
+def load(path:str, filters:list | None = None, sparse:bool = True
+        ) -> tuple[np.ndarray, np.ndarray, np.ndarray | sp.csr_matrix, list]:
+    """
+    Args:
+        path (str): full.parquet or bucket.parquet
+        filters (list | None): predicates pushed down to the reader, e.g. [("DATE", ">=", 20200101)]
+        sparse (bool): if True the bucket dummies of the compact schema are a scipy.sparse block
+            and M is a csr_matrix, otherwise M is dense.
+
+    Returns:
+        logIV, DATE, M and the names of the columns of M, with dummies only for the buckets that
+        occur in the selected rows
+    """
+    table = pq.read_table(path, filters=filters)
+    logIV = _column(table, "logIV")
+    dates = _column(table, "DATE")
+    if "joint_bucket" not in table.column_names:
+        names = [c for c in table.column_names if c not in ("DATE", "logIV")]
+        M = np.column_stack([_column(table, c).astype(np.float64) for c in names])
+        keep = _observed_dummies(M, [c.startswith("bucket_") for c in names])
+        return logIV, dates, M[:, keep], [c for c, k in zip(names, keep) if k]
+
+    features = [c for c in table.column_names if c not in ("DATE", "logIV", "joint_bucket")]
+    bucket = table.column("joint_bucket").combine_chunks()
+    if not pa.types.is_dictionary(bucket.type):
+        bucket = bucket.dictionary_encode()
+    # categories that never occur would give all-zero dummies, the first observed one is the base
+    observed, codes = np.unique(bucket.indices.to_numpy(zero_copy_only=False), return_inverse=True)
+    categories = [bucket.dictionary[i].as_py() for i in observed]
+    names = features + ["bucket_" + c for c in categories[1:]]
+    M = _csr([_column(table, c) for c in features], codes, len(categories))
+    return logIV, dates, M if sparse else M.toarray(), names
@@ -6,11 +6,16 @@ Implementation and notation based on:
 Durbin, J. and Siem Jan Koopman (2012). Time Series Analysis by State Space Methods. OUP Oxford.
 """
 
+from __future__ import annotations
+
+import os
 import numpy as np
-from _backend._np import scan
+from _backend import get_backend
+from _instrument import stage, iterations
 from scipy.optimize import minimize, approx_fprime
 
-def _filter(data: np.ndarray, dynamics:callable, params:dict, carry0:tuple)->dict:
+def _filter(data: np.ndarray, dynamics:callable, params:dict, carry0:tuple,
+        output:str = "full", steady_tol:float | None = None, backend:str | None = None)->dict:
     """Kalman Filter implementation
 
     Args:
@@ -18,39 +23,335 @@ def _filter(data: np.ndarray, dynamics:callable, params:dict, carry0:tuple)->dic
         dynamics (callable): function that specifies Zt, Tt, Rt and Qt
         params (dict): parameters of the model
         carry0 (tuple[float, float]): initial state prediction and variance
+        output (str): what is stored for every time step.
+            "loglik": nothing, only the loglikelihood is accumulated in the carry.
+            "states": a, P, logdetF and quad.
+            "full": also the system matrices, v, F and K.
+        steady_tol (float | None): only for time-invariant system matrices, dynamics must not
+            depend on idx (not the case of ss._dynamics, whose Z_t are the covariates of date
+            idx: the frozen terms would be silently wrong). Once
+            max|P_{t+1} - P_t| < steady_tol, F, its inverse, K and logdetF are frozen and the
+            following steps only update the state, without calling dynamics. A step with missing
+            values goes back to the full recursion. Defaults to None (never frozen).
+            numpy backend only.
+        backend (str | None): "numpy" or "jax", defaults to the current backend of _backend.
+            With JAX the recursion is a lax.scan and the function can be traced by jax.jit and
+            differentiated by jax.grad, dynamics must then use the array namespace of its inputs.
+        Missing entries of yt (NaN) get a zero innovation, dynamics must set their rows of Zt
+        to zero and their variance in Ht to one for them to drop out of the likelihood.
+        Ht may also be returned as a (p,) vector of variances, as for _collapsed_filter.
+
+    Returns:
+        dict with the stored terms, "loglikelihood" and the last "carry"
     """
+    if output not in ("loglik", "states", "full"):
+        raise ValueError(f"output must be 'loglik', 'states' or 'full', got {output}")
+    bk = get_backend(backend)
+    xp = bk.xp
+    if steady_tol is not None and bk.name != "numpy":
+        raise ValueError("steady_tol is only available with the numpy backend")
     def _step(carry, yt):
         """we carry forward at and Pt for prediction and filter, sum """
-        at_pred, Pt_pred, Zt, Tt, Ht, Rt, Qt, idx= carry
-        Zt, Tt, Ht, Rt, Qt = dynamics(yt, at_pred, Pt_pred, params, Zt, Tt, Ht, Rt, Qt, idx)
-        vt = yt - Zt @ at_pred
-        ZP = Zt @ Pt_pred
-        Ft = ZP @ Zt.T + Ht
-        L = np.linalg.cholesky(Ft)
-        tmp = np.linalg.solve(L, ZP)
-        Kt = Tt @ (np.linalg.solve(L.T, tmp).T)
-        at_filt = Tt @ at_pred + Kt @ vt
-        Ptp1 = Tt @ Pt_pred @ Tt.T + Rt @ Qt @ Rt.T - Kt @ Ft @ Kt.T
-        Linv_v = np.linalg.solve(L, vt)
-        quad_t = Linv_v.T @ Linv_v
-        logdet_t = 2.0 * np.sum(np.log(np.diag(L)))
-        idx +=1
-        new_carry = (at_filt, Ptp1, Zt, Tt, Ht, Rt, Qt, idx)
+        (at_pred, Pt_pred, Zt, Tt, Ht, Rt, Qt, idx), ll, steady = carry
+        if steady is not None and not np.isnan(yt).any():
+            Ft, Finv, Kt, logdet_t = steady
+            vt = yt - Zt @ at_pred
+            at_filt = Tt @ at_pred + Kt @ vt
+            Ptp1 = Pt_pred
+            quad_t = vt @ Finv @ vt
+        else:
+            Zt, Tt, Ht, Rt, Qt = dynamics(yt, at_pred, Pt_pred, params, Zt, Tt, Ht, Rt, Qt, idx)
+            if Ht.ndim == 1: Ht = xp.diag(Ht)
+            vt = xp.where(xp.isnan(yt), 0.0, yt - Zt @ at_pred)
+            ZP = Zt @ Pt_pred
+            Ft = ZP @ Zt.T + Ht
+            L = xp.linalg.cholesky(Ft)
+            tmp = xp.linalg.solve(L, ZP)
+            Kt = Tt @ (xp.linalg.solve(L.T, tmp).T)
+            at_filt = Tt @ at_pred + Kt @ vt
+            Ptp1 = Tt @ Pt_pred @ Tt.T + Rt @ Qt @ Rt.T - Kt @ (ZP @ Tt.T)
+            Linv_v = xp.linalg.solve(L, vt)
+            quad_t = Linv_v.T @ Linv_v
+            logdet_t = 2.0 * xp.sum(xp.log(xp.diag(L)))
+            steady = None
+            # a step with missing values has masked rows of Zt and unit variances in Ht, the
+            # frozen terms must come from a fully observed step
+            if (steady_tol is not None and not np.isnan(yt).any()
+                    and np.max(np.abs(Ptp1 - Pt_pred)) < steady_tol):
+                Linv = np.linalg.solve(L, np.eye(L.shape[0]))
+                steady = (Ft, Linv.T @ Linv, Kt, logdet_t)
+        # not in place: idx may be the 0-d array of the caller's carry
+        idx = idx + 1
+        new_carry = ((at_filt, Ptp1, Zt, Tt, Ht, Rt, Qt, idx), ll - 0.5 * (logdet_t + quad_t), steady)
+        if output == "loglik":
+            return new_carry, None
+        if output == "states":
+            return new_carry, {"a": at_filt, "P": Ptp1, "logdetF": logdet_t, "quad": quad_t}
         store_timet = {"a": at_filt,"P": Ptp1,"Z": Zt,"T": Tt,
             "H": Ht,"R": Rt,"Q": Qt,"v": vt,
-            "F": Ft,"logdetF": logdet_t,"quad": quad_t,}
+            "F": Ft,"K": Kt,"logdetF": logdet_t,"quad": quad_t,}
         return new_carry, store_timet
 
-    _, ll_terms = scan(_step, carry0, data)
-    return ll_terms 
+    carry0 = tuple(xp.asarray(c) for c in carry0)
+    (carry, ll, _), ll_terms = bk.scan(_step, (carry0, xp.asarray(0.0), None), xp.asarray(data))
+    out = {} if ll_terms is None else ll_terms
+    out["loglikelihood"] = ll
+    out["carry"] = carry
+    return out
+
+def _collapsed_filter(data: np.ndarray, dynamics:callable, params:dict, carry0:tuple,
+        output:str = "loglik", backend:str | None = None)->dict:
+    """Kalman filter for a wide cross-section and diagonal H_t, in the spirit of
+    Jungbacker and Koopman (2015), Likelihood-based dynamic factor analysis for measurement and forecasting.
+
+    y_t enters the recursion only through C_t = Z_t' H_t^{-1} Z_t and b_t = Z_t' H_t^{-1} y_t,
+    the update is done in the state dimension m:
+
+        P_filt = (I + P_t C_t)^{-1} P_t,   w_t = b_t - C_t a_t,   a_filt = a_t + P_filt w_t
+        v_t' F_t^{-1} v_t = v_t' H_t^{-1} v_t - w_t' P_filt w_t
+        log|F_t| = log|H_t| + log|I + P_t C_t|
+
+    so the cost per step is O(p m^2) instead of O(p^3), and C_t does not need to be invertible.
+    Same arguments and loglikelihood as _filter; Ht may be returned by dynamics as a (p,) vector
+    of variances or as a diagonal matrix. Missing entries of yt (NaN) are set to zero, with the
+    zero rows of Zt and unit variances set by dynamics they drop out exactly as in _filter.
+
+    Args:
+        output (str): "loglik" or "states" (a, P, logdetF, quad).
+        backend (str | None): as in _filter.
+    """
+    if output not in ("loglik", "states"):
+        raise ValueError(f"output must be 'loglik' or 'states', got {output}")
+    bk = get_backend(backend)
+    xp = bk.xp
+    def _step(carry, yt):
+        (at_pred, Pt_pred, Zt, Tt, Ht, Rt, Qt, idx), ll = carry
+        Zt, Tt, Ht, Rt, Qt = dynamics(yt, at_pred, Pt_pred, params, Zt, Tt, Ht, Rt, Qt, idx)
+        m = at_pred.shape[0]
+        y0 = xp.where(xp.isnan(yt), 0.0, yt)
+        h = Ht if Ht.ndim == 1 else xp.diagonal(Ht)
+        ZH = Zt.T / h
+        Ct = ZH @ Zt
+        bt = ZH @ y0
+        wt = bt - Ct @ at_pred
+        vHv = y0 @ (y0 / h) - 2.0 * at_pred @ bt + at_pred @ Ct @ at_pred
+        S = xp.eye(m) + Pt_pred @ Ct
+        P_filt = xp.linalg.solve(S, Pt_pred)
+        P_filt = 0.5 * (P_filt + P_filt.T)
+        a_filt = at_pred + P_filt @ wt
+        quad_t = vHv - wt @ P_filt @ wt
+        logdet_t = xp.sum(xp.log(h)) + xp.linalg.slogdet(S)[1]
+        at_next = Tt @ a_filt
+        Ptp1 = Tt @ P_filt @ Tt.T + Rt @ Qt @ Rt.T
+        idx = idx + 1
+        new_carry = ((at_next, Ptp1, Zt, Tt, h, Rt, Qt, idx), ll - 0.5 * (logdet_t + quad_t))
+        if output == "loglik":
+            return new_carry, None
+        return new_carry, {"a": at_next, "P": Ptp1, "logdetF": logdet_t, "quad": quad_t}
+
+    carry0 = tuple(xp.asarray(c) for c in carry0)
+    # the carry holds H_t as a vector so that its shape is the same at every step
+    if carry0[4].ndim == 2: carry0 = carry0[:4] + (xp.diagonal(carry0[4]),) + carry0[5:]
+    (carry, ll), ll_terms = bk.scan(_step, (carry0, xp.asarray(0.0)), xp.asarray(data))
+    out = {} if ll_terms is None else ll_terms
+    out["loglikelihood"] = ll
+    out["carry"] = carry
+    return out
+
+def _batch_filter(data: np.ndarray, dynamics:callable, params:dict, carry0:tuple,
+        output:str = "loglik", backend:str | None = None)->dict:
+    """Kalman filter over a leading batch axis, e.g. stacked parameter sets of a multi-start
+    optimisation and/or stacked panels of several underlyings with the same number of dates.
+
+    Same recursion and loglikelihood as _filter, with batched matrix products and solves so that
+    one pass evaluates all the likelihoods of the batch. dynamics must broadcast over the leading
+    axes of yt and of the arrays in params (see models.ss._system). Its output at the first date
+    sets the batch shape of the carry, the shapes of the system matrices must then stay the same.
+
+    Args:
+        data (ndarray): (..., n, p), a panel without batch axes is shared by the whole batch
+        params (dict): parameters, arrays with the batch axes leading
+        carry0 (tuple): initial carry of _filter, a and P may or may not have the batch axes
+        output (str): "loglik" or "states" (a, P, logdetF and quad, batch axes leading).
+        backend (str | None): as in _filter.
+        A member whose F_t is singular or has a negative determinant gets a -inf
+        loglikelihood instead of stopping the whole batch.
+
+    Returns:
+        dict with the stored terms, "loglikelihood" of shape batch and the last "carry"
+    """
+    if output not in ("loglik", "states"):
+        raise ValueError(f"output must be 'loglik' or 'states', got {output}")
+    bk = get_backend(backend)
+    xp = bk.xp
+    mT = lambda x: xp.swapaxes(x, -1, -2)
+    def _step(carry, yt):
+        (at_pred, Pt_pred, Zt, Tt, Ht, Rt, Qt, idx), ll = carry
+        Zt, Tt, Ht, Rt, Qt = dynamics(yt, at_pred, Pt_pred, params, Zt, Tt, Ht, Rt, Qt, idx)
+        vt = xp.where(xp.isnan(yt), 0.0, yt - (Zt @ at_pred[..., None])[..., 0])
+        ZP = Zt @ Pt_pred
+        Ft = ZP @ mT(Zt) + Ht
+        sign, logdet_t = xp.linalg.slogdet(Ft)
+        m = at_pred.shape[-1]
+        ok = sign > 0
+        # members with a degenerate F_t solve with the identity and are set to -inf
+        Fs = xp.where(ok[..., None, None], Ft, xp.eye(Ft.shape[-1]))
+        X = xp.linalg.solve(Fs, xp.concatenate([ZP, vt[..., None]], axis=-1))
+        Finv_ZP, Finv_v = X[..., :m], X[..., m]
+        quad_t = xp.sum(vt * Finv_v, axis=-1)
+        at_filt = (Tt @ (at_pred + (mT(ZP) @ Finv_v[..., None])[..., 0])[..., None])[..., 0]
+        P_upd = Pt_pred - mT(ZP) @ Finv_ZP
+        Ptp1 = Tt @ (0.5 * (P_upd + mT(P_upd))) @ mT(Tt) + Rt @ Qt @ mT(Rt)
+        ll = ll - 0.5 * xp.where(ok, logdet_t + quad_t, xp.inf)
+        new_carry = ((at_filt, Ptp1, Zt, Tt, Ht, Rt, Qt, idx + 1), ll)
+        if output == "loglik":
+            return new_carry, None
+        return new_carry, {"a": at_filt, "P": Ptp1, "logdetF": logdet_t, "quad": quad_t}
+
+    data = xp.asarray(data)
+    a0, P0, Z0, T0, H0, R0, Q0, idx0 = tuple(xp.asarray(c) for c in carry0)
+    Z0, T0, H0, R0, Q0 = dynamics(data[..., 0, :], a0, P0, params, Z0, T0, H0, R0, Q0, idx0)
+    batch = np.broadcast_shapes(data.shape[:-2], a0.shape[:-1], P0.shape[:-2],
+        Z0.shape[:-2], T0.shape[:-2], H0.shape[:-2], R0.shape[:-2], Q0.shape[:-2])
+    carry0 = (xp.broadcast_to(a0, batch + a0.shape[-1:]), xp.broadcast_to(P0, batch + P0.shape[-2:]),
+        Z0, T0, H0, R0, Q0, idx0)
+    (carry, ll), ll_terms = bk.scan(_step, (carry0, xp.zeros(batch)), xp.moveaxis(data, -2, 0))
+    out = {} if ll_terms is None else {k: xp.moveaxis(v, 0, len(batch)) for k, v in ll_terms.items()}
+    out["loglikelihood"] = ll
+    out["carry"] = carry
+    return out
 
 def _loglikelihood(filter_output:dict):
     """Without constant term"""
-    return -0.5 * np.sum(filter_output["logdetF"] + filter_output["quad"])
+    return filter_output["loglikelihood"]
+
+def _backward(filter_output:dict)->dict:
+    """Backward smoothing recursion on the output of _filter(..., output="full")
+
+        r_{t-1} = Z_t' F_t^{-1} v_t + L_t' r_t,   N_{t-1} = Z_t' F_t^{-1} Z_t + L_t' N_t L_t
+        u_t = F_t^{-1} v_t - K_t' r_t,           D_t = F_t^{-1} + K_t' N_t K_t
+
+    with L_t = T_t - K_t Z_t and r_n = 0, N_n = 0 (Durbin and Koopman, 2012, ch. 4).
+    r[t], N[t] are r_t, N_t (they refer to alpha_{t+1}), r_prev[t], N_prev[t] are r_{t-1}, N_{t-1}.
+    """
+    Z, T, F, K, v = (filter_output[c] for c in ("Z", "T", "F", "K", "v"))
+    n, p, m = Z.shape
+    r = np.zeros((n, m)); N = np.zeros((n, m, m))
+    r_prev = np.empty((n, m)); N_prev = np.empty((n, m, m))
+    u = np.empty((n, p)); D = np.empty((n, p, p)); L = np.empty((n, m, m))
+    rt, Nt = np.zeros(m), np.zeros((m, m))
+    for t in range(n - 1, -1, -1):
+        r[t], N[t] = rt, Nt
+        cF = np.linalg.cholesky(F[t])
+        Finv = np.linalg.solve(cF.T, np.linalg.solve(cF, np.eye(p)))
+        Finv_v = Finv @ v[t]
+        L[t] = T[t] - K[t] @ Z[t]
+        u[t] = Finv_v - K[t].T @ rt
+        D[t] = Finv + K[t].T @ Nt @ K[t]
+        rt = Z[t].T @ Finv_v + L[t].T @ rt
+        Nt = Z[t].T @ Finv @ Z[t] + L[t].T @ Nt @ L[t]
+        r_prev[t], N_prev[t] = rt, Nt
+    return {"r": r, "N": N, "r_prev": r_prev, "N_prev": N_prev, "u": u, "D": D, "L": L}
+
+def _predictions(filter_output:dict, carry0:tuple)->tuple[np.ndarray, np.ndarray]:
+    """One step ahead predictions a_t, P_t used at every step of the filter"""
+    a = np.concatenate([carry0[0][None], filter_output["a"][:-1]])
+    P = np.concatenate([carry0[1][None], filter_output["P"][:-1]])
+    return a, P
+
+def _smoother(filter_output:dict, carry0:tuple, backward:dict | None = None)->dict:
+    """State and disturbance smoother (Durbin and Koopman, 2012, sec. 4.4-4.5 and 4.7)
+
+        alpha_hat_t = a_t + P_t r_{t-1},   V_t = P_t - P_t N_{t-1} P_t
+        eps_hat_t = H_t u_t,               Var(eps_t|Y) = H_t - H_t D_t H_t
+        eta_hat_t = Q_t R_t' r_t,          Var(eta_t|Y) = Q_t - Q_t R_t' N_t R_t Q_t
+        Cov(alpha_{t+1}, alpha_t|Y) = (I - P_{t+1} N_t) L_t P_t
+
+    lag_cov has n - 1 entries, lag_cov[t] is the covariance of alpha_{t+1} and alpha_t.
+    """
+    b = _backward(filter_output) if backward is None else backward
+    a, P = _predictions(filter_output, carry0)
+    H, Q, R = filter_output["H"], filter_output["Q"], filter_output["R"]
+    m = a.shape[1]
+    alpha_hat = a + np.einsum("tij,tj->ti", P, b["r_prev"])
+    V = P - P @ b["N_prev"] @ P
+    eps_hat = np.einsum("tij,tj->ti", H, b["u"])
+    eps_var = H - H @ b["D"] @ H
+    QR = Q @ np.swapaxes(R, 1, 2)
+    eta_hat = np.einsum("tij,tj->ti", QR, b["r"])
+    eta_var = Q - QR @ b["N"] @ np.swapaxes(QR, 1, 2)
+    lag_cov = (np.eye(m) - P[1:] @ b["N"][:-1]) @ b["L"][:-1] @ P[:-1]
+    return {"alpha": alpha_hat, "V": V, "eps": eps_hat, "eps_var": eps_var,
+        "eta": eta_hat, "eta_var": eta_var, "lag_cov": lag_cov}
+
+def _score_matrices(filter_output:dict, carry0:tuple, backward:dict | None = None)->dict:
+    """Gradient of the loglikelihood w.r.t. the system matrices of every time step
+    (Koopman and Shephard, 1992), with dl = tr(G' dM) for each matrix M:
+
+        G_H = (u_t u_t' - D_t) / 2
+        G_Q = R_t' (r_t r_t' - N_t) R_t / 2
+        G_T = r_t hat_alpha_t' - N_t L_t P_t,   hat_alpha_t = a_t + P_t r_{t-1}
+
+    The initial state a_1, P_1 is taken as fixed. The model gradient follows by chain rule.
+    """
+    b = _backward(filter_output) if backward is None else backward
+    a, P = _predictions(filter_output, carry0)
+    R = filter_output["R"]
+    r, N, u = b["r"], b["N"], b["u"]
+    alpha_hat = a + np.einsum("tij,tj->ti", P, b["r_prev"])
+    G_H = 0.5 * (u[:, :, None] * u[:, None, :] - b["D"])
+    rrN = r[:, :, None] * r[:, None, :] - N
+    G_Q = 0.5 * np.einsum("tji,tjk,tkl->til", R, rrN, R)
+    G_T = r[:, :, None] * alpha_hat[:, None, :] - N @ b["L"] @ P
+    return {"H": G_H, "Q": G_Q, "T": G_T}
+
+_carry_keys = ("a", "P", "Z", "T", "H", "R", "Q", "idx")
+
+def _save_state(path:str, state:dict):
+    """Writes an online filter state to an .npz file, replaced atomically so that an interrupted
+    update leaves the previous state on disk.
+
+    Args:
+        state (dict): "carry" (filter carry), "loglikelihood" (cumulative), "params" (dict of
+        arrays) and any other scalar entries, e.g. the date of the last re-estimation.
+    """
+    arrays = dict(zip(_carry_keys, (np.asarray(c) for c in state["carry"])))
+    arrays |= {"param_" + k: np.asarray(v) for k, v in state.get("params", {}).items()}
+    arrays |= {"info_" + k: np.asarray(v) for k, v in state.items() if k not in ("carry", "params")}
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+def _load_state(path:str)->dict:
+    with np.load(path) as f:
+        carry = tuple(f[k] for k in _carry_keys[:-1]) + (int(f["idx"]),)
+        params = {k[6:]: f[k] for k in f.files if k.startswith("param_")}
+        info = {k[5:]: f[k][()] for k in f.files if k.startswith("info_")}
+    return info | {"carry": carry, "params": params}
+
+def _update(state:dict, data:np.ndarray, dynamics:callable, params:dict | None = None,
+        output:str = "full", backend:str | None = None)->tuple[dict, dict]:
+    """Advances an online filter state over the new dates in data, the cost does not depend on
+    the length of the history already filtered.
+
+    Args:
+        state (dict): as in _save_state, e.g. {"carry": out["carry"], "loglikelihood": out["loglikelihood"]}
+        params (dict | None): parameters passed to dynamics. Defaults to state["params"].
+    Returns:
+        the new state and the _filter output of the new dates
+    """
+    if params is None: params = state["params"]
+    with stage("kalman.update", steps=data.shape[0]):
+        out = _filter(data, dynamics, params, state["carry"], output=output, backend=backend)
+    new_state = state | {"carry": out["carry"],
+        "loglikelihood": state["loglikelihood"] + out["loglikelihood"]}
+    return new_state, out
 
 def _fit(data: np.ndarray, initial_guess: dict, covariates:np.ndarray | None, carry_initial:tuple,
     _dynamics:callable, _link:callable | None = None, _invlink: callable | None = None,
-    opt_options:dict | None = None)->dict:
+    opt_options:dict | None = None, jac:callable | None = None, collapsed:bool = False,
+    steady_tol:float | None = None, backend:str | None = None)->dict:
     """
     Args:
         data (np.ndarray)
@@ -60,19 +361,72 @@ def _fit(data: np.ndarray, initial_guess: dict, covariates:np.ndarray | None, ca
         _link (callable | None, optional): function that maps uncostrained, ndarray parameters to
         constrained space and returns them in a dictionary. Defaults to None.
         _invlink (callable | None, optional): inverse of _link. Defaults to None.
+        jac (callable | None, optional): analytic score, function of (unconstrained parameters,
+        constrained parameters, full filter output) returning the gradient of the loglikelihood
+        w.r.t. the unconstrained parameters, e.g. built on _score_matrices. If None BFGS uses
+        finite differences. Defaults to None.
+        collapsed (bool, optional): evaluate the likelihood with _collapsed_filter, for wide
+        cross-sections with diagonal H. Only used without jac, the score needs the full filter.
+        steady_tol (float | None, optional): steady state tolerance of _filter for the likelihood
+        evaluations of time-invariant models, not available with covariates (Z_t changes with
+        the date). Defaults to None.
+        backend (str | None, optional): backend of the likelihood evaluations, see _backend.
+        With "jax" and no jac the criterion is jit-compiled and differentiated by reverse mode
+        autodiff through the scan, _dynamics and _link must then be written with
+        _backend.namespace. Defaults to the active backend.
     """
+    bk = get_backend(backend)
+    if steady_tol is not None and covariates is not None:
+        raise ValueError("steady_tol needs time-invariant system matrices, the covariates make Z_t change with the date")
     if _link is None: _link = lambda x: x
     if _invlink is None: _invlink = lambda x: x
     initial_guess["covariates"] = covariates
     unc_params = _invlink(initial_guess)
     def _criterion(params):
         constr_params = _link(params)
-        kf = _filter(data, _dynamics, constr_params, carry_initial)
+        try:
+            if collapsed:
+                kf = _collapsed_filter(data, _dynamics, constr_params, carry_initial, output="loglik",
+                    backend=bk.name)
+            else:
+                kf = _filter(data, _dynamics, constr_params, carry_initial, output="loglik",
+                    steady_tol=steady_tol, backend=bk.name)
+        except np.linalg.LinAlgError:
+            return np.inf
         return  - _loglikelihood(kf)
-    res = minimize(_criterion, unc_params, options=opt_options, method="BFGS")
+    def _criterion_jac(params):
+        """one full filter and smoother pass for both value and gradient"""
+        constr_params = _link(params)
+        try:
+            kf = _filter(data, _dynamics, constr_params, carry_initial, output="full", backend=bk.name)
+        except np.linalg.LinAlgError:
+            return np.inf, np.zeros_like(params)
+        return - _loglikelihood(kf), - jac(params, constr_params, kf)
+    def _negloglik(params):
+        kf = (_collapsed_filter if collapsed else _filter)(data, _dynamics, _link(params),
+            carry_initial, output="loglik", backend=bk.name)
+        return - kf["loglikelihood"]
+    def _criterion_autodiff(params):
+        value, grad = _value_and_grad(params)
+        value = float(value)
+        if not np.isfinite(value): return np.inf, np.zeros_like(params)
+        return value, np.asarray(grad, dtype=float)
+    with stage("kalman.fit", backend=bk.name, T=data.shape[0]) as rec:
+        callback = iterations("kalman.fit")
+        if jac is None and bk.value_and_grad is not None:
+            _value_and_grad = bk.jit(bk.value_and_grad(_negloglik))
+            res = minimize(_criterion_autodiff, unc_params, options=opt_options, method="BFGS",
+                jac=True, callback=callback)
+        elif jac is None:
+            res = minimize(_criterion, unc_params, options=opt_options, method="BFGS", callback=callback)
+        else:
+            res = minimize(_criterion_jac, unc_params, options=opt_options, method="BFGS", jac=True,
+                callback=callback)
+        # filter steps over all the likelihood evaluations
+        rec |= {"niter": res.nit, "nfev": res.nfev, "steps": res.nfev * data.shape[0]}
     unc_params = res.x
-    params = _link(unc_params)
-    kf = _filter(data, _dynamics, params, carry_initial)
+    params = bk.to_numpy(_link(unc_params))
+    kf = bk.to_numpy(_filter(data, _dynamics, params, carry_initial, backend=bk.name))
     out = {
         "loglikelihood": - res.fun,
         "niter": res.nit,
@@ -82,21 +436,78 @@ def _fit(data: np.ndarray, initial_guess: dict, covariates:np.ndarray | None, ca
     }
     return params | kf | out
 
-def _simulation(fit_output: dict, nsim: int, dynamics: callable, npaths: int):
-    Qt, Ht = fit_output["Q"][-1], fit_output["H"][-1]
-    at, Pt = fit_output["a"][-1], fit_output["P"][-1]
-    Zt, Tt = fit_output["Z"][-1], fit_output["T"][-1]
-    Rt = fit_output["R"][-1]
-    carry0 = (at, Pt, Zt, Tt, Ht, Rt, Qt, 0)
-    q = carry0[6].shape[0]
-    p = carry0[4].shape[0]
-    eta_draws = np.random.multivariate_normal(np.zeros(q), carry0[6], size=(nsim, npaths))
-    eps_draws = np.random.multivariate_normal(np.zeros(p), carry0[4], size=(nsim, npaths))
-    dummy = np.empty((nsim, npaths, p))
-    out = _filter(dummy, dynamics, fit_output, carry0)
-    y_sim = np.einsum("tij,tj->ti", out["Z"], out["a"]) if out["Z"].ndim == 3 else (out["a"] @ out["Z"].transpose(0, 2, 1))
-    y_sim = y_sim + eps_draws
-    out["y"] = y_sim
-    out["eta"] = eta_draws
-    out["eps"] = eps_draws
+def _sqrt_cov(M:np.ndarray)->np.ndarray:
+    """S with S S' = M for a positive semidefinite M, the vector of standard deviations
+    when M is diagonal (or already given as a vector of variances)"""
+    if M.ndim == 1: return np.sqrt(M)
+    if not np.any(M - np.diag(np.diagonal(M))): return np.sqrt(np.diagonal(M))
+    w, V = np.linalg.eigh(M)
+    return V * np.sqrt(np.clip(w, 0.0, None))
+
+def _draw(rng:np.random.Generator, S:np.ndarray, size:int)->np.ndarray:
+    z = rng.standard_normal((size, S.shape[0]))
+    return z * S if S.ndim == 1 else z @ S.T
+
+def _simulate(fit_output:dict, nsim:int, dynamics:callable, npaths:int, params:dict | None = None,
+        seed=None, chunk_size:int = 10_000, states:bool = False):
+    """Simulates npaths paths of nsim steps after the sample, from the predictive distribution
+    of the last filtered state alpha_{n+1} ~ N(a, P), propagating a chunk of paths at once:
+
+        y_t = Z_t alpha_t + eps_t,   alpha_{t+1} = T_t alpha_t + R_t eta_t
+
+    The system matrices come from dynamics at every step, called with a fully observed y_t and
+    idx continuing from the last carry, so params must cover the dates after the sample.
+
+    Args:
+        fit_output (dict): output of _fit (or _filter), uses its "carry"
+        params (dict | None): parameters passed to dynamics. Defaults to fit_output.
+        seed: seed of the np.random.SeedSequence, every chunk draws from its own spawned stream,
+            results are reproducible for the same seed and chunk_size.
+        chunk_size (int): number of paths propagated together, bounds the memory.
+        states (bool): also yields the simulated states.
+    Yields:
+        (slice of the paths, dict with "y" (m, nsim, p) and with states "alpha" (m, nsim, s))
+    """
+    if params is None: params = fit_output
+    a0, P0, Z0, T0, H0, R0, Q0, idx0 = (np.asarray(c) for c in fit_output["carry"])
+    p, s = Z0.shape
+    y_obs = np.zeros(p)
+    S0 = _sqrt_cov(P0)
+    nchunks = -(-npaths // chunk_size)
+    streams = np.random.SeedSequence(seed).spawn(nchunks)
+    for j, stream in enumerate(streams):
+        rng = np.random.default_rng(stream)
+        paths = slice(j * chunk_size, min((j + 1) * chunk_size, npaths))
+        m = paths.stop - paths.start
+        alpha = a0 + _draw(rng, S0, m)
+        out = {"y": np.empty((m, nsim, p))}
+        if states: out["alpha"] = np.empty((m, nsim, s))
+        Zt, Tt, Ht, Rt, Qt = Z0, T0, H0, R0, Q0
+        for t in range(nsim):
+            Zt, Tt, Ht, Rt, Qt = dynamics(y_obs, a0, P0, params, Zt, Tt, Ht, Rt, Qt, idx0 + t)
+            out["y"][:, t] = alpha @ Zt.T + _draw(rng, _sqrt_cov(Ht), m)
+            if states: out["alpha"][:, t] = alpha
+            alpha = alpha @ Tt.T + _draw(rng, _sqrt_cov(Qt), m) @ Rt.T
+        yield paths, out
+
+def _simulation(fit_output:dict, nsim:int, dynamics:callable, npaths:int, params:dict | None = None,
+        seed=None, chunk_size:int = 10_000, states:bool = False, path:str | None = None)->dict:
+    """Collects the chunks of _simulate in (npaths, nsim, dim) arrays.
+
+    Args:
+        path (str | None): directory where y.npy (and alpha.npy) are written as memory-mapped
+            arrays chunk by chunk, so that only one chunk is held in memory. Defaults to None (in memory).
+    """
+    p, s = np.shape(fit_output["carry"][2])
+    shapes = {"y": (npaths, nsim, p)} | ({"alpha": (npaths, nsim, s)} if states else {})
+    if path is None:
+        out = {k: np.empty(v) for k, v in shapes.items()}
+    else:
+        os.makedirs(path, exist_ok=True)
+        out = {k: np.lib.format.open_memmap(os.path.join(path, k + ".npy"), mode="w+", shape=v)
+            for k, v in shapes.items()}
+    for paths, chunk in _simulate(fit_output, nsim, dynamics, npaths, params, seed, chunk_size, states):
+        for k in out: out[k][paths] = chunk[k]
+    if path is not None:
+        for v in out.values(): v.flush()
     return out
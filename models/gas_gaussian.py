@@ -1,61 +1,315 @@
 """Base for the implementation of the IV models of Zou, Lin and Lucas (2025)
 
-TODO: generalize to nonbucketed data (covariance in filter, storing eps)
+    y_t = M_t beta_t + eps_t,   eps_t ~ N(0, H_t + M_t C M_t')
+    beta_{t+1} = (I - B) bar_beta + B beta_t + A (M_t' S_t^{-1} M_t)^{-1} M_t' S_t^{-1} eps_t
+
+with S_t = H_t + M_t C M_t' and H_t diagonal. The panel is unbucketed: every date has its own
+number of quotes n_t, the rows of the same date are stored contiguously (sorted by date).
 """
 
+import os
 import numpy as np
 import pandas as pd
-from numpy.linalg import inv
+import scipy.sparse as sp
+from scipy.optimize import minimize
+from _backend import get_backend, namespace
+from _instrument import stage, iterations
+
+def _date_index(dates:np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Stable order that sorts the rows by date, unique dates and CSR offsets: the rows of
+    dates_unique[i] are order[offsets[i]:offsets[i + 1]]"""
+    order = np.argsort(dates, kind="stable")
+    dates_unique, starts = np.unique(dates[order], return_index=True)
+    return order, dates_unique, np.append(starts, dates.shape[0])
+
+def _arrays(data:pd.DataFrame | tuple) -> tuple:
+    """logIV, DATE and M of a DataFrame (DATE, logIV and the columns of M) or of a tuple
+    (logIV, DATE, M) such as _design.load(path)[:3], M dense or scipy.sparse, without the rows
+    with a missing or infinite value (e.g. the quotes flagged MISSING_UNDERLYING by the filter,
+    which are kept in the dataset). Also returns the positions of the kept rows in data."""
+    if isinstance(data, pd.DataFrame):
+        logIV, dates = data["logIV"].to_numpy(dtype=np.float64), data["DATE"].to_numpy()
+        M = data.drop(columns=["DATE", "logIV"]).to_numpy(dtype=np.float64)
+    else:
+        logIV, dates, M = data
+        logIV, dates = np.asarray(logIV, dtype=np.float64), np.asarray(dates)
+        M = sp.csr_matrix(M, dtype=np.float64) if sp.issparse(M) else np.asarray(M, dtype=np.float64)
+    if sp.issparse(M):
+        bad = np.bincount(np.repeat(np.arange(M.shape[0]), np.diff(M.indptr)),
+            ~np.isfinite(M.data), M.shape[0]) > 0
+    else:
+        bad = ~np.isfinite(M).all(axis=1)
+    rows = np.flatnonzero(np.isfinite(logIV) & ~bad)
+    return logIV[rows], dates[rows], M[rows], rows
+
+def _moments(logIV:np.ndarray, M:np.ndarray, offsets:np.ndarray, groups:np.ndarray,
+        ngroups:int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Sufficient statistics of every date and variance group, computed once per panel:
+    MM (T, ngroups, k, k) = M_tg' M_tg, My (T, ngroups, k) = M_tg' y_tg, yy (T, ngroups) = y_tg' y_tg
+    and the number of quotes n (T, ngroups). M dense or scipy.sparse."""
+    T = offsets.shape[0] - 1
+    k = M.shape[1]
+    MM, My = np.zeros((T, ngroups, k, k)), np.zeros((T, ngroups, k))
+    yy, n = np.zeros((T, ngroups)), np.zeros((T, ngroups))
+    onehot = np.eye(ngroups)
+    for i in range(T):
+        s, e = offsets[i], offsets[i + 1]
+        M_t = M[s:e]
+        if sp.issparse(M_t): M_t = M_t.toarray()
+        G_t = onehot[groups[s:e]]
+        MG = G_t[:, :, None] * M_t[:, None, :]
+        MM[i] = np.einsum("ngi,nj->gij", MG, M_t)
+        My[i] = np.einsum("ngi,n->gi", MG, logIV[s:e])
+        yy[i] = G_t.T @ logIV[s:e]**2
+        n[i] = G_t.sum(axis=0)
+    return MM, My, yy, n
 
-def _filter(logIV:np.ndarray, M:np.ndarray, 
-        dates:np.ndarray, dates_unique:np.ndarray, 
-        params:dict)-> tuple[np.ndarray, np.ndarray, np.ndarray]:
+def _factor(C:np.ndarray) -> np.ndarray:
+    """L with C = L L', also when C is only semidefinite"""
+    w, V = np.linalg.eigh(C)
+    return V * np.sqrt(np.clip(w, 0.0, None))
+
+def _recursion(moments:tuple, params:dict, beta0=None, backend:str | None = None,
+        ridge:float = 1e-6) -> tuple:
     """
-    Recursion over time of the model.
-    dates: array of dates as in the dataset
-    dates_unique: array of unique values for dates
+    Recursion over time of the model on the statistics of _moments, scanned with the backend.
+    params: B, bar_beta, h (ngroups,) variances of the groups, C or its factor L and optionally A
+    beta0: beta of the first date. Defaults to bar_beta.
+
+    S_t = H_t + M_t C M_t' is never formed: with H_t diagonal and C = L L', the Woodbury identity
+    and the matrix determinant lemma reduce every solve to the k x k matrix W_t = I + L' G_t L,
+    G_t = M_t' H_t^{-1} M_t = sum_g M_tg' M_tg / h_g, so that a step costs O(ngroups k^2 + k^3)
+    whatever the number of quotes:
+
+        M_t' S_t^{-1} x = g - G_t L W_t^{-1} L' g,   g = M_t' H_t^{-1} x
+        log|S_t| = log|H_t| + log|W_t|
+
+    The scaled score is solved with the Cholesky factor of the information M_t' S_t^{-1} M_t.
+    A factor without quotes on the day (e.g. the dummy of an empty bucket) gets no update, and
+    a ridge of ridge times the diagonal keeps the factorisation defined when the day's quotes
+    leave a combination of factors unidentified (e.g. with one representative per bucket, the
+    dummies of the quoted buckets span the continuous factors). The score has no component
+    along such a combination, so the step is close to the minimum norm one; without the ridge
+    the roundoff along it makes the likelihood too rough for BFGS.
+
+    Returns:
+        betas (T, k): beta_{t+1} after the update with the quotes of date t
+        loglikelihood (T,): contribution of every date, without constant term
     """
-    p = B.shape[0]
+    bk = get_backend(backend)
+    xp = bk.xp
     B = params["B"]
-    C = params["C"]
     bar_beta = params["bar_beta"]
-    H = params["H"]
-    I = np.eye(p)
+    h = params["h"]
+    k = B.shape[0]
+    I = xp.eye(k)
+    A = params.get("A", I)
+    L = params["L"] if "L" in params else xp.asarray(_factor(np.asarray(params["C"])))
     const = (I - B) @ bar_beta
-    beta_t = bar_beta
-
-    betas = np.empty_like((B.shape[0], p))
-    eps = np.empty_like(betas)
-    Hadjs = []
-
-    def beta_update(beta_t:np.ndarray,
-        eps_t:np.ndarray, M_t:np.ndarray)->np.ndarray:
-        """One step of the filter"""
-        A = I
-        Hadj = H + M_t @ C @ M_t.T
-        Hinv = inv(Hadj)
-        scaled_score = A @ inv(M_t.T @ Hinv @ M_t) @ M_t.T @ Hinv @ eps_t
-        return const + B @ beta_t + scaled_score, Hadj
-    
-    for i,t in enumerate(dates_unique):
-        idx = dates == t
-        logIV_t = logIV[idx]
-        M_t = M[idx]
-        eps_t = logIV_t - M_t @ beta_t
-        beta_t, Hadj_t = beta_update(beta_t, eps_t, M_t)
-        betas[i] = beta_t
-        eps[i] = eps_t
-        Hadjs.append(Hadj_t)
-    
-    return (betas, eps, np.array(Hadjs))
-    
-def _fit(data:pd.DataFrame) -> dict:
+    log_h = xp.log(h)
+
+    def _step(beta_t, x):
+        MM, My, yy, n = x
+        G = xp.tensordot(1.0 / h, MM, axes=1)
+        My_h = (1.0 / h) @ My
+        g = My_h - G @ beta_t
+        # eps' H^-1 eps with eps = y - M beta
+        eHe = (1.0 / h) @ yy - 2.0 * beta_t @ My_h + beta_t @ G @ beta_t
+        GL = G @ L
+        Lg = L.T @ g
+        # W >= I is always positive definite
+        W_chol = xp.linalg.cholesky(I + L.T @ GL)
+        X = bk.cho_solve(W_chol, xp.concatenate([GL.T, Lg[:, None]], axis=1))
+        observed = xp.diagonal(G) > 0.0
+        info = xp.where(observed[:, None] & observed[None, :], G - GL @ X[:, :k], I)
+        info = 0.5 * (info + info.T) + ridge * xp.diag(xp.diagonal(info))
+        score = xp.where(observed, g - GL @ X[:, k], 0.0)
+        step = bk.cho_solve(xp.linalg.cholesky(info), score)
+        logdet = n @ log_h + 2.0 * xp.sum(xp.log(xp.diagonal(W_chol)))
+        beta_next = const + B @ beta_t + A @ step
+        return beta_next, (beta_next, - 0.5 * (logdet + eHe - Lg @ X[:, k]))
+
+    beta0 = bar_beta if beta0 is None else xp.asarray(beta0)
+    _, (betas, loglik) = bk.scan(_step, beta0, tuple(xp.asarray(m) for m in moments))
+    return betas, loglik
+
+def _errors(logIV:np.ndarray, M:np.ndarray, offsets:np.ndarray, betas_pred:np.ndarray) -> np.ndarray:
+    """Prediction errors y - M_t beta_t of the rows, betas_pred (T, k) the beta of every date"""
+    date = np.repeat(np.arange(offsets.shape[0] - 1), np.diff(offsets))
+    if sp.issparse(M):
+        M = M.tocsr()
+        rows = np.repeat(np.arange(M.shape[0]), np.diff(M.indptr))
+        fitted = np.bincount(rows, M.data * betas_pred[date[rows], M.indices], M.shape[0])
+    else:
+        fitted = np.einsum("nk,nk->n", M, betas_pred[date])
+    return logIV - fitted
+
+def _filter(logIV:np.ndarray, M:np.ndarray, offsets:np.ndarray, params:dict,
+        beta0:np.ndarray | None = None, groups:np.ndarray | None = None,
+        backend:str | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Filter of the panel, see _recursion.
+    logIV, M: rows sorted by date, M dense or scipy.sparse
+    offsets: CSR offsets of the dates, see _date_index
+    params: B, C, bar_beta, h and optionally A
+    groups: variance group of every row, index of h. Defaults to a single group.
+
+    Returns:
+        betas (T, k): beta_{t+1} after the update with the quotes of date t
+        eps (N,): prediction errors of the rows, in the order of logIV
+        loglikelihood (T,): contribution of every date, without constant term
+    """
+    if groups is None: groups = np.zeros(logIV.shape[0], dtype=np.intp)
+    h = np.atleast_1d(params["h"])
+    moments = _moments(logIV, M, offsets, groups, h.shape[0])
+    bk = get_backend(backend)
+    betas, loglik = bk.to_numpy(_recursion(moments, params | {"h": h}, beta0, backend=bk.name))
+    beta0 = params["bar_beta"] if beta0 is None else beta0
+    eps = _errors(logIV, M, offsets, np.vstack([beta0, betas[:-1]]))
+    return (betas, eps, loglik)
+
+def _link(x, k:int, ngroups:int) -> dict:
+    """Unconstrained vector to parameters: B and bar_beta free, C = LL' with log-diagonal
+    Cholesky factor L (also returned), log-variances of H by group. Written with the array
+    namespace of x for autodiff."""
+    xp = namespace(x)
+    i = 0
+    B = x[i:i + k * k].reshape(k, k); i += k * k
+    bar_beta = x[i:i + k]; i += k
+    nl = k * (k + 1) // 2
+    rows, cols = np.tril_indices(k)
+    scatter = np.zeros((k * k, nl))
+    scatter[rows * k + cols, np.arange(nl)] = 1.0
+    L = (xp.asarray(scatter) @ x[i:i + nl]).reshape(k, k); i += nl
+    L = xp.tril(L, -1) + xp.diag(xp.exp(xp.diag(L)))
+    return {"B": B, "bar_beta": bar_beta, "C": L @ L.T, "L": L, "h": xp.exp(x[i:i + ngroups])}
+
+def _invlink(params:dict) -> np.ndarray:
+    k = params["B"].shape[0]
+    L = np.linalg.cholesky(params["C"])
+    L[np.diag_indices(k)] = np.log(np.diag(L))
+    return np.concatenate([params["B"].ravel(), params["bar_beta"], L[np.tril_indices(k)],
+        np.log(params["h"])])
+
+def _initial_guess(moments:tuple) -> dict:
+    """Pooled OLS for bar_beta and the variances, persistent B and small C"""
+    MM, My, yy, n = (m.sum(axis=0) for m in moments)
+    k = MM.shape[-1]
+    bar_beta = np.linalg.lstsq(MM.sum(axis=0), My.sum(axis=0), rcond=None)[0]
+    rss = yy - 2.0 * My @ bar_beta + np.einsum("gij,i,j->g", MM, bar_beta, bar_beta)
+    h = rss / np.maximum(n, 1)
+    return {"B": 0.9 * np.eye(k), "bar_beta": bar_beta, "C": 0.01 * np.eye(k),
+        "h": np.maximum(h / 2.0, 1e-8)}
+
+def _fit(data:pd.DataFrame | tuple, initial_guess:dict | None = None, groups:np.ndarray | None = None,
+        opt_options:dict | None = None, backend:str | None = None) -> dict:
     """
     correction: function to add back possible constant terms from the likelihood that are not used in optimization
     dates in the dataset must be in YYYYMMDD format to work properly
+
+    The statistics of _moments are computed once, every likelihood evaluation costs O(T k^3)
+    whatever the number of quotes.
+
+    Args:
+        data (pd.DataFrame | tuple): DATE, logIV and the columns of M, one row per quote, or the
+            arrays (logIV, DATE, M) with M dense or scipy.sparse, e.g. _design.load(path)[:3]
+        initial_guess (dict | None): B, bar_beta, C and h. Defaults to _initial_guess.
+        groups (np.ndarray | None): integer codes of the rows sharing a variance in H, e.g. the
+            joint bucket. Defaults to a single variance.
+        backend (str | None): with "jax" the likelihood is jit-compiled and BFGS gets its exact
+            gradient by autodiff through the scan, with numpy finite differences.
+            Defaults to the active backend, see _backend.
+
+    Returns:
+        parameters, betas, eps (rows of data in the order "order", sorted by date, without the
+        rows with missing values), dates and the optimisation output
     """
-    logIV = data["logIV"].to_numpy()
-    dates = data["DATE"].to_numpy()
-    M = data.drop(columns=["DATE", "logIV"])
-    dates_unique = np.unique(dates)
+    logIV, dates, M, rows = _arrays(data)
+    if logIV.shape[0] == 0:
+        raise ValueError("no quotes without missing values to fit")
+    groups = np.zeros(logIV.shape[0], dtype=np.intp) if groups is None else np.asarray(groups)[rows]
+    order, dates_unique, offsets = _date_index(dates)
+    logIV, M, groups = logIV[order], M[order], groups[order]
+    k = M.shape[1]
+    ngroups = int(groups.max()) + 1
+    moments = _moments(logIV, M, offsets, groups, ngroups)
+    if initial_guess is None: initial_guess = _initial_guess(moments)
+    bk = get_backend(backend)
+
+    def _negloglik(x, moments):
+        return - _recursion(moments, _link(x, k, ngroups), backend=bk.name)[1].sum()
+    if bk.value_and_grad is not None:
+        _value_and_grad = bk.jit(bk.value_and_grad(_negloglik))
+        moments_bk = tuple(bk.xp.asarray(m) for m in moments)
+        def _criterion(x):
+            value, grad = _value_and_grad(bk.xp.asarray(x), moments_bk)
+            value = float(value)
+            if not np.isfinite(value): return np.inf, np.zeros_like(x)
+            return value, np.asarray(grad, dtype=float)
+    else:
+        def _criterion(x):
+            try:
+                value = float(_negloglik(x, moments))
+            except np.linalg.LinAlgError:
+                return np.inf
+            return value if np.isfinite(value) else np.inf
+    with stage("gas.fit", backend=bk.name, T=offsets.shape[0] - 1, rows_in=logIV.shape[0]) as rec:
+        res = minimize(_criterion, _invlink(initial_guess), options=opt_options, method="BFGS",
+            jac=bk.value_and_grad is not None, callback=iterations("gas.fit"))
+        rec |= {"niter": res.nit, "nfev": res.nfev, "steps": res.nfev * (offsets.shape[0] - 1)}
+    params = {key: np.asarray(v) for key, v in _link(res.x, k, ngroups).items()}
+    betas, eps, loglik = _filter(logIV, M, offsets, params, groups=groups)
+    return params | {
+        "betas": betas,
+        "eps": eps,
+        "loglikelihood_dates": loglik,
+        "order": rows[order],
+        "dates": dates_unique,
+        "loglikelihood": - res.fun,
+        "niter": res.nit,
+        "is_converged": res.success,
+        "gradient": res.jac,
+        "hessian_inv": res.hess_inv
+    }
 
+def save_state(path:str, fit_output:dict):
+    """Writes the online state (beta of the next date, cumulative loglikelihood and parameters)
+    to an .npz file, replaced atomically"""
+    arrays = {k: np.asarray(fit_output[k]) for k in ("B", "bar_beta", "C", "h", "loglikelihood")}
+    arrays["beta"] = fit_output["betas"][-1]
+    arrays["last_date"] = fit_output["dates"][-1]
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+def update(path:str, data:pd.DataFrame | tuple, groups:np.ndarray | None = None) -> dict:
+    """Filters the quotes of the new dates from the state saved at path and saves the advanced
+    state, the cost does not depend on the length of the history. Dates up to the last filtered
+    one are rejected: filtering them again would count their likelihood twice. Without new
+    quotes the state is left as is.
+
+    Args:
+        data (pd.DataFrame | tuple): quotes of the new dates, as in _fit
+        groups (np.ndarray | None): variance groups of the rows, as in _fit
+    """
+    with np.load(path) as f:
+        state = {k: f[k] for k in f.files}
+    logIV, dates, M, rows = _arrays(data)
+    params = {k: state[k] for k in ("B", "bar_beta", "C", "h")}
+    if logIV.shape[0] == 0:
+        return params | {"betas": np.empty((0, params["B"].shape[0])), "eps": np.empty(0),
+            "order": rows, "dates": dates, "loglikelihood_dates": np.empty(0),
+            "loglikelihood": state["loglikelihood"]}
+    if (dates <= state["last_date"]).any():
+        raise ValueError(f"the state at {path} is already filtered up to {state['last_date']}, "
+            f"got dates from {dates.min()}")
+    groups = np.zeros(logIV.shape[0], dtype=np.intp) if groups is None else np.asarray(groups)[rows]
+    order, dates_unique, offsets = _date_index(dates)
+    with stage("gas.update", steps=dates_unique.shape[0], rows_in=logIV.shape[0]):
+        betas, eps, loglik = _filter(logIV[order], M[order], offsets, params,
+            beta0=state["beta"], groups=groups[order])
+    out = params | {"betas": betas, "eps": eps, "order": rows[order], "dates": dates_unique,
+        "loglikelihood_dates": loglik, "loglikelihood": state["loglikelihood"] + loglik.sum()}
+    save_state(path, out)
+    return out
@@ -1,17 +1,277 @@
+"""Dynamic factor model for the IV surface in state space form
+
+    y_t = M_t beta_t + eps_t,                          eps_t ~ N(0, H), H diagonal
+    beta_{t+1} = (I - B) bar_beta + B beta_t + eta_t,  eta_t ~ N(0, Q)
+
+The intercept is handled by augmenting the state with a constant, alpha_t = (beta_t, 1).
+Missing IVs (NaN in y_t) get a zero row in Z_t and a unit variance in H_t, so that they do
+not contribute to the likelihood.
+"""
+
 import numpy as np
+from _backend import get_backend, namespace
+from _instrument import emit
 from models._kalman import _filter as kfilter
-from models._kalman import _simulation
+from models._kalman import _fit, _score_matrices, _smoother, _backward, _batch_filter
+from models._kalman import _simulation, _save_state, _load_state, _update
 
-def _dynamics(y, _a, _P, params, _Z, bt, _H, identity_mat, _Q, idx)->dict:
-    p = bt.shape[0]
-    Q = params["Q_param"]
-    H = params["H_param"]
-    Mt = params["covariates"][idx * p : (1 + idx)*p, :]
+def _system(y, params, idx)->tuple:
+    """Z_t, T and R of the augmented state, rows of Z_t of missing IVs set to zero.
+    Broadcasts over leading batch axes of y and of the parameters (see _kalman._batch_filter)."""
+    xp = namespace(y)
+    p = y.shape[-1]
+    k = params["B"].shape[-1]
+    Mt = xp.take(params["covariates"], idx * p + xp.arange(p), axis=-2)
     bar_beta = params["bar_beta"]
     B = params["B"]
-    Z = np.where(np.isnan(y), 0.0, Mt)
-    T = (identity_mat - B) @ bar_beta + B @ bt
-    return Z, T, H, identity_mat, Q
+    miss = xp.isnan(y)
+    Mt = xp.where(miss[..., None], 0.0, Mt)
+    Z = xp.concatenate([Mt, xp.zeros_like(Mt[..., :1])], axis=-1)
+    c = bar_beta - (B @ bar_beta[..., None])[..., 0]
+    last = xp.broadcast_to(xp.eye(1, k + 1, k), B.shape[:-2] + (1, k + 1))
+    T = xp.concatenate([xp.concatenate([B, c[..., None]], axis=-1), last], axis=-2)
+    R = xp.eye(k + 1, k)
+    return Z, T, R, miss
+
+def _dynamics(y, _a, _P, params, _Z, _T, _H, _R, _Q, idx)->dict:
+    xp = namespace(y)
+    Z, T, R, miss = _system(y, params, idx)
+    H = xp.where(miss[..., :, None] | miss[..., None, :], xp.eye(y.shape[-1]), params["H_param"])
+    return Z, T, H, R, params["Q_param"]
+
+def _dynamics_collapsed(y, _a, _P, params, _Z, _T, _H, _R, _Q, idx)->dict:
+    """Same system as _dynamics with H_t as a vector of variances, for _kalman._collapsed_filter"""
+    xp = namespace(y)
+    Z, T, R, miss = _system(y, params, idx)
+    h = xp.where(miss, 1.0, xp.diagonal(params["H_param"], axis1=-2, axis2=-1))
+    return Z, T, h, R, params["Q_param"]
+
+def _carry0(k:int, p:int, a0:np.ndarray | None = None, P0:np.ndarray | None = None, kappa:float = 10.0)->tuple:
+    """Initial carry, by default beta_1 ~ N(0, kappa I). The constant state has zero variance."""
+    at = np.zeros(k + 1)
+    at[k] = 1.0
+    Pt = np.zeros((k + 1, k + 1))
+    Pt[:k, :k] = kappa * np.eye(k) if P0 is None else P0
+    if a0 is not None: at[:k] = a0
+    return (at, Pt, np.zeros((p, k + 1)), np.eye(k + 1), np.eye(p), np.eye(k + 1, k), np.eye(k), 0)
+
+def _link(x:np.ndarray, k:int, p:int)->dict:
+    """Unconstrained vector to parameters: B and bar_beta free, Q = LL' with log-diagonal
+    Cholesky factor, H diagonal with log-variances. Works on numpy and JAX arrays, and on
+    a (..., d) stack of vectors."""
+    xp = namespace(x)
+    batch = x.shape[:-1]
+    i = 0
+    B = x[..., i:i + k * k].reshape(batch + (k, k)); i += k * k
+    bar_beta = x[..., i:i + k]; i += k
+    rows, cols = np.tril_indices(k)
+    S = np.zeros((k * k, rows.shape[0]))
+    S[rows * k + cols, np.arange(rows.shape[0])] = 1.0
+    L = (x[..., i:i + k * (k + 1) // 2] @ S.T).reshape(batch + (k, k)); i += k * (k + 1) // 2
+    d = xp.diagonal(L, axis1=-2, axis2=-1)
+    L = L + (xp.exp(d) - d)[..., None, :] * np.eye(k)
+    H = xp.exp(x[..., i:i + p])[..., None, :] * np.eye(p)
+    return {"B": B, "bar_beta": bar_beta, "Q_param": L @ xp.swapaxes(L, -1, -2), "H_param": H}
+
+def _invlink(params:dict)->np.ndarray:
+    k = params["B"].shape[0]
+    L = np.linalg.cholesky(params["Q_param"])
+    L[np.diag_indices(k)] = np.log(np.diag(L))
+    return np.concatenate([params["B"].ravel(), params["bar_beta"],
+        L[np.tril_indices(k)], np.log(np.diag(params["H_param"]))])
+
+def _score(x:np.ndarray, params:dict, filter_output:dict, carry0:tuple, data:np.ndarray)->np.ndarray:
+    """Analytic gradient of the loglikelihood w.r.t. the unconstrained parameters of _link,
+    chain rule on the system matrix scores of _kalman._score_matrices"""
+    k = params["B"].shape[0]
+    G = _score_matrices(filter_output, carry0)
+    # H_t equals H_param only on the pairs of observed entries
+    observed = ~np.isnan(data)
+    G_H = np.einsum("tii,ti->i", G["H"], observed)
+    G_Q = G["Q"].sum(axis=0)
+    G_T = G["T"].sum(axis=0)[:k]
+    B, bar_beta = params["B"], params["bar_beta"]
+    g_B = G_T[:, :k] - np.outer(G_T[:, k], bar_beta)
+    g_bar_beta = (np.eye(k) - B).T @ G_T[:, k]
+    L = np.linalg.cholesky(params["Q_param"])
+    g_L = 2.0 * G_Q @ L
+    g_L[np.diag_indices(k)] *= np.diag(L)
+    g_h = G_H * np.diag(params["H_param"])
+    return np.concatenate([g_B.ravel(), g_bar_beta, g_L[np.tril_indices(k)], g_h])
+
+def _initial_guess(data:np.ndarray, covariates:np.ndarray)->dict:
+    """Pooled OLS for bar_beta and H, persistent B and small Q"""
+    k = covariates.shape[1]
+    y = data.ravel()
+    ok = ~np.isnan(y)
+    bar_beta = np.linalg.lstsq(covariates[ok], y[ok], rcond=None)[0]
+    resid = np.where(ok, y - covariates @ bar_beta, np.nan).reshape(data.shape)
+    return {"B": 0.9 * np.eye(k), "bar_beta": bar_beta, "Q_param": 0.01 * np.eye(k),
+        "H_param": np.diag(np.nanvar(resid, axis=0) / 2.0)}
+
+def fit(data:np.ndarray, covariates:np.ndarray, initial_guess:dict | None = None,
+        carry0:tuple | None = None, opt_options:dict | None = None, analytic:bool | None = None,
+        collapsed:bool = False, backend:str | None = None)->dict:
+    """
+    Args:
+        data (np.ndarray): (n, p) log IVs, NaN for missing
+        covariates (np.ndarray): (n * p, k) stacked M_t
+        analytic (bool | None): BFGS with the analytic score, otherwise with finite differences.
+            Defaults to True unless collapsed.
+        collapsed (bool): evaluates the likelihood with the collapsed filter, whose cost does not
+            grow with p^3 (full panel padded with NaN). The analytic score needs the full filter,
+            so collapsed=True implies analytic=False.
+        backend (str | None): "jax" replaces the analytic score by autodiff of the jitted
+            (collapsed) filter. Defaults to the active backend, see _backend.
+    """
+    n, p = data.shape
+    k = covariates.shape[1]
+    if initial_guess is None: initial_guess = _initial_guess(data, covariates)
+    if carry0 is None: carry0 = _carry0(k, p)
+    if collapsed and analytic:
+        raise ValueError("the analytic score needs the full filter, use analytic=False with collapsed=True")
+    if analytic is None: analytic = not collapsed
+    if get_backend(backend).value_and_grad is not None: analytic = False
+    link = lambda x: _link(x, k, p) | {"covariates": covariates}
+    jac = (lambda x, params, kf: _score(x, params, kf, carry0, data)) if analytic else None
+    dynamics = _dynamics_collapsed if collapsed else _dynamics
+    return _fit(data, dict(initial_guess), covariates, carry0, dynamics,
+        link, _invlink, opt_options, jac=jac, collapsed=collapsed, backend=backend)
+
+def save_state(path:str, fit_output:dict):
+    """Initialises the online state of update with the output of fit or em"""
+    params = {k: fit_output[k] for k in ("B", "bar_beta", "Q_param", "H_param")}
+    nobs = int(fit_output["carry"][7])
+    _save_state(path, {"carry": fit_output["carry"], "loglikelihood": fit_output["loglikelihood"],
+        "params": params, "last_fit": nobs})
+
+def update(path:str, data:np.ndarray, covariates:np.ndarray, start:int, refit_every:int | None = None,
+        history:tuple | None = None, opt_options:dict | None = None)->dict:
+    """Filters the new dates from the state saved at path and saves the advanced state,
+    instead of filtering the whole history again.
+
+    Args:
+        data (np.ndarray): (n_new, p) log IVs of the new dates
+        covariates (np.ndarray): (n_new * p, k) stacked M_t of the new dates
+        start (int): index of the first new date in the whole sample, must be the number of
+            dates already filtered: an overlap would count dates twice and a gap skip them
+        refit_every (int | None): re-estimates the parameters once refit_every dates have been
+            added since the last estimation, starting from the current ones
+        history (tuple | None): (data, covariates) of the whole sample including the new dates,
+            needed for the re-estimation
+    Returns:
+        dict with the filter output of the new dates, or the fit output after a re-estimation
+    """
+    state = _load_state(path)
+    if start != state["carry"][7]:
+        raise ValueError(f"the state at {path} has filtered {state['carry'][7]} dates, "
+            f"the new dates must start at that index, got start={start}")
+    nobs = state["carry"][7] + data.shape[0]
+    if refit_every is not None and nobs - state["last_fit"] >= refit_every:
+        if history is None:
+            raise ValueError("history = (data, covariates) is needed to re-estimate the parameters")
+        res = fit(*history, initial_guess=state["params"], opt_options=opt_options)
+        save_state(path, res)
+        return res
+    # dynamics indexes the covariates with idx, restarted from zero on the new dates
+    state["carry"] = state["carry"][:7] + (0,)
+    state, out = _update(state, data, _dynamics, state["params"] | {"covariates": covariates})
+    state["carry"] = state["carry"][:7] + (nobs,)
+    _save_state(path, state)
+    return out
+
+def loglikelihood(x:np.ndarray, data:np.ndarray, covariates:np.ndarray, carry0:tuple | None = None,
+        backend:str | None = None)->np.ndarray:
+    """Loglikelihood of a batch in one pass of _kalman._batch_filter, e.g. all the starting
+    points of a multi-start optimisation or the same parameters on several underlyings.
+
+    Args:
+        x (np.ndarray): (..., d) unconstrained parameters, see _link
+        data (np.ndarray): (n, p) or (..., n, p) log IVs, NaN for missing
+        covariates (np.ndarray): (n * p, k) or (..., n * p, k) stacked M_t
+    Returns:
+        np.ndarray: loglikelihoods with the broadcast batch shape, -inf where F_t is degenerate
+    """
+    n, p = data.shape[-2:]
+    k = covariates.shape[-1]
+    if carry0 is None: carry0 = _carry0(k, p)
+    params = _link(x, k, p) | {"covariates": covariates}
+    return _batch_filter(data, _dynamics, params, carry0, backend=backend)["loglikelihood"]
+
+def _em_step(data:np.ndarray, params:dict, filter_output:dict, carry0:tuple)->dict:
+    """Closed form M-step given the smoothed moments of alpha_t = (beta_t, 1) and eps_t"""
+    k = params["B"].shape[0]
+    n = data.shape[0]
+    sm = _smoother(filter_output, carry0, _backward(filter_output))
+    alpha, V = sm["alpha"], sm["V"]
+    Eaa = V + alpha[:, :, None] * alpha[:, None, :]
+    S00 = Eaa[:-1].sum(axis=0)
+    S10 = (sm["lag_cov"] + alpha[1:, :, None] * alpha[:-1, None, :]).sum(axis=0)[:k]
+    S11 = Eaa[1:, :k, :k].sum(axis=0)
+    W = np.linalg.solve(S00, S10.T).T
+    B, c = W[:, :k], W[:, k]
+    Q = (S11 - W @ S10.T) / (n - 1)
+    observed = ~np.isnan(data)
+    Eee = sm["eps"] ** 2 + np.diagonal(sm["eps_var"], axis1=1, axis2=2)
+    h = np.sum(np.where(observed, Eee, 0.0), axis=0) / np.maximum(observed.sum(axis=0), 1)
+    return {"B": B, "bar_beta": np.linalg.solve(np.eye(k) - B, c),
+        "Q_param": 0.5 * (Q + Q.T), "H_param": np.diag(h), "covariates": params["covariates"]}
+
+def em(data:np.ndarray, covariates:np.ndarray, initial_guess:dict | None = None,
+        carry0:tuple | None = None, maxiter:int = 500, tol:float = 1e-8,
+        switch_tol:float | None = None, opt_options:dict | None = None)->dict:
+    """EM estimation with the state and disturbance smoother (Shumway and Stoffer, 1982;
+    Durbin and Koopman, 2012, sec. 7.3.4), the initial state is kept fixed.
+
+    Args:
+        tol (float): stops when the relative increase of the loglikelihood is below tol
+        switch_tol (float | None): if given, once the relative increase is below switch_tol
+            the estimation is finished by fit (BFGS with the analytic score) from the EM estimate.
+    """
+    n, p = data.shape
+    k = covariates.shape[1]
+    if initial_guess is None: initial_guess = _initial_guess(data, covariates)
+    if carry0 is None: carry0 = _carry0(k, p)
+    params = dict(initial_guess) | {"covariates": covariates}
+    lls = []
+    is_converged = False
+    for _ in range(maxiter):
+        kf = kfilter(data, _dynamics, params, carry0)
+        lls.append(kf["loglikelihood"])
+        emit("iteration", stage="ss.em", iteration=len(lls), loglikelihood=float(lls[-1]))
+        if len(lls) > 1:
+            change = (lls[-1] - lls[-2]) / abs(lls[-2])
+            if change < tol:
+                is_converged = True
+                break
+            if switch_tol is not None and change < switch_tol:
+                res = fit(data, covariates, params, carry0, opt_options)
+                return res | {"em_loglikelihood": np.array(lls), "em_niter": len(lls)}
+        params = _em_step(data, params, kf, carry0)
+    if not is_converged:
+        # the filter output and loglikelihood of the last M-step
+        kf = kfilter(data, _dynamics, params, carry0)
+        lls.append(kf["loglikelihood"])
+    out = {
+        "loglikelihood": lls[-1],
+        "niter": len(lls),
+        "is_converged": is_converged,
+        "em_loglikelihood": np.array(lls)
+    }
+    return params | kf | out
+
+def simulation(fit_output:dict, nsim:int, npaths:int, covariates:np.ndarray | None = None,
+        seed=None, chunk_size:int = 10_000, states:bool = False, path:str | None = None)->dict:
+    """Simulated log IV surfaces for the nsim dates after the sample, see _kalman._simulation.
 
-def simulation(fit_output, nsim, npaths):
-    return _simulation(fit_output, nsim, _dynamics, npaths)
\ No newline at end of file
+    Args:
+        covariates (np.ndarray | None): (nsim * p, k) stacked M_t of the simulated dates.
+            Defaults to the M_t of the last date of the sample, repeated.
+    Returns:
+        dict with "y" (npaths, nsim, p), and "alpha" (npaths, nsim, k + 1) with states.
+    """
+    p = fit_output["carry"][2].shape[0]
+    in_sample = fit_output["covariates"]
+    if covariates is None: covariates = np.tile(in_sample[-p:], (nsim, 1))
+    params = fit_output | {"covariates": np.concatenate([in_sample, covariates])}
+    return _simulation(fit_output, nsim, _dynamics, npaths, params, seed, chunk_size, states, path)
@@ -0,0 +1,218 @@
+"""Runs filter -> structure -> scaling and model for several underlyings as a dependency graph.
+
+Run from the repository root, with the raw files of every underlying in data/<underlying>/raw:
+
+    python pipeline.py SPY QQQ IWM --workers 3
+    python pipeline.py SPY --stages filter structure scaling model
+
+The stages of different underlyings are independent and run concurrently in a process pool.
+A stage is skipped when the key of its last run, a hash of the contents of its inputs, of its
+configuration and of the source of its modules, is unchanged and its outputs exist. Keys and
+the content hashes of the input files are kept in data/<underlying>/pipeline.json, a file
+is read again only when its size or modification time changed. A new ticker runs only its own
+stages, a new day reruns the stages of its underlying, and filter still reprocesses only the
+changed raw files (see filter.main), unless its source or configuration changed since its last
+run: then it rebuilds its outputs from scratch (incremental=False).
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+root = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "1cleaning"))
+sys.path.insert(0, os.path.join(root, "2holder_est"))
+from _instrument import emit
+from filter import _file_hash
+
+model_columns = ["DATE", "logIV", "level", "moneyness", "moneyness2", "maturity", "interaction"]
+
+def _run_filter(underlying:str, config:dict):
+    import filter
+    filter.main(workers=config.get("filter_workers", 1), incremental=config.get("incremental", True),
+        subfolder=underlying)
+
+def _run_structure(underlying:str, config:dict):
+    import structure
+    structure.main(compact=config.get("compact", False), subfolder=underlying)
+
+def _run_scaling(underlying:str, config:dict):
+    import disjoint_scales
+    result = disjoint_scales.compute(underlying, config.get("columns"), minf=config.get("minf", 1.0),
+        maxf=config.get("maxf", 126.0))
+    disjoint_scales.render(result, underlying, workers=1)
+
+def _run_model(underlying:str, config:dict):
+    """GAS model of models.gas_gaussian on the bucket representatives, state in put/gas/state.npz"""
+    import pandas as pd
+    from models import gas_gaussian
+    data = pd.read_parquet("data/" + underlying + "/put/bucket.parquet",
+        columns=config.get("model_columns", model_columns)).dropna()
+    res = gas_gaussian._fit(data, opt_options=config.get("opt_options"),
+        backend=config.get("model_backend", "jax"))
+    os.makedirs("data/" + underlying + "/put/gas", exist_ok=True)
+    gas_gaussian.save_state("data/" + underlying + "/put/gas/state.npz", res)
+
+def _graph(underlying:str) -> dict:
+    """Stages of one underlying: function, upstream stages, input and output paths, source
+    files and the keys of the run configuration they depend on"""
+    put = "data/" + underlying + "/put/"
+    return {
+        "filter": {"run": _run_filter, "deps": [], "inputs": ["data/" + underlying + "/raw"],
+            "outputs": [put + "checks.parquet", put + "checks/all.parquet", put + "manifest.json",
+                "data/put/filtered/UNDERLYING=" + underlying],
+            "code": ["1cleaning/filter.py", "1cleaning/_dataset.py"], "config": []},
+        "structure": {"run": _run_structure, "deps": ["filter"],
+            "inputs": ["data/put/filtered/UNDERLYING=" + underlying],
+            "outputs": [put + "full.parquet", put + "bucket.parquet", put + "bucket_matrix.parquet"],
+            "code": ["1cleaning/structure.py", "1cleaning/_dataset.py"], "config": ["compact"]},
+        "scaling": {"run": _run_scaling, "deps": ["structure"], "inputs": [put + "bucket_matrix.parquet"],
+            "outputs": ["plot/" + underlying + "/put/moments_scaling_.pdf"],
+            "code": ["2holder_est/disjoint_scales.py", "2holder_est/univariate_scaling.py"],
+            "config": ["columns", "minf", "maxf"]},
+        "model": {"run": _run_model, "deps": ["structure"], "inputs": [put + "bucket.parquet"],
+            "outputs": [put + "gas/state.npz"],
+            "code": ["models/gas_gaussian.py"], "config": ["model_columns", "opt_options", "model_backend"]},
+    }
+
+def _files(path:str) -> list:
+    if os.path.isfile(path): return [path]
+    return sorted(os.path.join(d, f) for d, _, files in os.walk(path) for f in files)
+
+def _code_key(stage:dict, config:dict) -> str:
+    """Hash of the configuration used by the stage and of its source"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps({k: config.get(k) for k in stage["config"]}, sort_keys=True, default=str).encode())
+    for f in stage["code"]:
+        h.update(_file_hash(os.path.join(root, f)).encode())
+    return h.hexdigest()
+
+def _stage_key(stage:dict, config:dict, hashes:dict) -> str:
+    """Hash of the input contents and of _code_key.
+    hashes caches the content hash of every file by (size, mtime_ns) and is updated in place."""
+    h = hashlib.blake2b(digest_size=16)
+    for path in stage["inputs"]:
+        for f in _files(path):
+            st = os.stat(f)
+            entry = hashes.get(f)
+            if entry is None or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+                entry = hashes[f] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": _file_hash(f)}
+            h.update(f.encode() + entry["hash"].encode())
+    h.update(_code_key(stage, config).encode())
+    return h.hexdigest()
+
+def _load(underlying:str) -> dict:
+    path = "data/" + underlying + "/pipeline.json"
+    if not os.path.exists(path): return {"files": {}, "stages": {}}
+    with open(path, "r") as fh:
+        return json.load(fh)
+
+def _save(underlying:str, state:dict):
+    path = "data/" + underlying + "/pipeline.json"
+    state["files"] = {f: e for f, e in state["files"].items() if os.path.exists(f)}
+    tmp = path + ".tmp"
+    with open(tmp, "w") as fh:
+        json.dump(state, fh, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def _timed(run:callable, underlying:str, config:dict) -> float:
+    start = time.perf_counter()
+    run(underlying, config)
+    return time.perf_counter() - start
+
+def run(underlyings:list, stages:list | None = None, workers:int | None = None,
+        config:dict | None = None, force:bool = False) -> dict:
+    """
+    Args:
+        underlyings (list): e.g. ["SPY", "QQQ"]
+        stages (list | None): stages to run, a stage left out is not a dependency of the others.
+            Defaults to filter, structure and scaling: the model estimation is only run on request.
+        workers (int | None): processes running the stages, 1 runs them in this process
+        config (dict | None): filter_workers (pool of filter.main inside its stage, default 1),
+            compact, columns, minf, maxf, model_columns, opt_options and model_backend (backend of
+            the model fit, default "jax" for the autodiff gradient, see _backend)
+        force (bool): runs every stage even when its key is unchanged
+    Returns:
+        dict (underlying, stage) -> {"status": "ran" | "cached" | "failed" | "blocked", ...}
+    """
+    if stages is None: stages = ["filter", "structure", "scaling"]
+    config = {} if config is None else config
+    graphs = {u: _graph(u) for u in underlyings}
+    states = {u: _load(u) for u in underlyings}
+    pending = [(u, s) for u in underlyings for s in stages]
+    deps = {(u, s): [(u, d) for d in graphs[u][s]["deps"] if d in stages] for u, s in pending}
+    results = {}
+    running = {}
+    pool = None if workers == 1 else ProcessPoolExecutor(max_workers=workers)
+
+    def submit(u:str, s:str, key:str, code:str, cfg:dict):
+        fut = Future()
+        if pool is not None:
+            fut = pool.submit(_timed, graphs[u][s]["run"], u, cfg)
+        else:
+            try:
+                fut.set_result(_timed(graphs[u][s]["run"], u, cfg))
+            except Exception as e:
+                fut.set_exception(e)
+        running[fut] = (u, s, key, code)
+
+    try:
+        while pending or running:
+            for task in list(pending):
+                status = [results.get(d, {}).get("status") for d in deps[task]]
+                if any(st in ("failed", "blocked") for st in status):
+                    results[task] = {"status": "blocked"}
+                elif all(st in ("ran", "cached") for st in status):
+                    u, s = task
+                    key = _stage_key(graphs[u][s], config, states[u]["files"])
+                    code = _code_key(graphs[u][s], config)
+                    last = states[u]["stages"].get(s, {})
+                    outputs = all(os.path.exists(p) for p in graphs[u][s]["outputs"])
+                    if not force and last.get("key") == key and outputs:
+                        results[task] = {"status": "cached", "key": key}
+                        emit("pipeline", underlying=u, stage=s, status="cached")
+                    else:
+                        # outputs kept across runs (filter's manifest) are stale after a change of
+                        # source or configuration, the stage rebuilds them from scratch
+                        rebuild = last.get("code") != code
+                        submit(u, s, key, code, config | {"incremental": False} if rebuild else config)
+                else:
+                    continue
+                pending.remove(task)
+            if not running: continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                u, s, key, code = running.pop(fut)
+                try:
+                    seconds = fut.result()
+                except Exception as e:
+                    results[(u, s)] = {"status": "failed", "error": repr(e)}
+                    emit("pipeline", underlying=u, stage=s, status="failed", error=repr(e))
+                    continue
+                results[(u, s)] = {"status": "ran", "key": key, "seconds": seconds}
+                states[u]["stages"][s] = {"key": key, "code": code, "seconds": seconds}
+                _save(u, states[u])
+                emit("pipeline", underlying=u, stage=s, status="ran", seconds=seconds)
+    finally:
+        if pool is not None: pool.shutdown(cancel_futures=True)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("underlyings", nargs="+")
+    parser.add_argument("--stages", nargs="*", choices=["filter", "structure", "scaling", "model"], default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--filter-workers", type=int, default=1)
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+    results = run(args.underlyings, args.stages, args.workers,
+        {"filter_workers": args.filter_workers, "compact": args.compact}, args.force)
+    for (u, s), res in results.items():
+        print(f"{u:8s} {s:10s} {res['status']:8s} " + (f"{res['seconds']:.2f}s" if "seconds" in res else res.get("error", "")))
+    sys.exit(int(any(res["status"] in ("failed", "blocked") for res in results.values())))
@@ -4,38 +4,84 @@ adapted from MSM, and compares to simulated MSM draws
 """
 
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 def _logit(x:np.ndarray):
     return 1/(1.0 + np.exp(-x))
 
-def gas_multifractal(nsim:int, rng:np.random.Generator,
+def gas_multifractal_paths(draws:np.ndarray,
     m0:float, psi_bar: float, k:int, f_initial:np.ndarray,
     gamma_1: float, b:float, alpha:float
     )->tuple[np.ndarray, np.ndarray]:
     """
-    psi = log sigma2
-    gaussian innovation
+    Same recursion as gas_multifractal for all the paths at once,
+    f_t is (npaths, k) and the loop is only over time.
+    draws: (npaths, nsim) standard normal innovations, kept fixed across
+    parameter values they give common random numbers
     """
-    draws = rng.standard_normal(size=nsim)
-    draws2 = draws**2
-    s = 0.5 * (draws2 - 1.0)
+    npaths, nsim = draws.shape
+    s = 0.5 * (draws**2 - 1.0)
     lm0 = np.log(m0)
     m1 = 2.0 - m0
     m01 = m1 / m0
     lm01 = np.log(m01)
-    sigma2 = np.empty(nsim, dtype=float)
+    sigma2 = np.empty((npaths, nsim), dtype=float)
     phi = np.exp(- gamma_1 * b ** np.arange(k))
-    f_t = f_initial
-    score_t = np.zeros(k, dtype=float)
+    f_t = np.broadcast_to(f_initial, (npaths, k)).astype(float)
+    score_t = np.zeros((npaths, k), dtype=float)
     for t in range(nsim):
         f_t = f_t * phi + alpha * score_t
         z_t = _logit(f_t)
-        sigma2[t] = np.exp(psi_bar + k * lm0 + lm01* np.sum(z_t))
-        # M_t = m0 *(m01) ** z_t
-        score_t = s[t] * z_t*(1.0 - z_t) * lm01
+        sigma2[:, t] = np.exp(psi_bar + k * lm0 + lm01 * np.sum(z_t, axis=1))
+        score_t = s[:, t, None] * z_t * (1.0 - z_t) * lm01
     returns = draws * np.sqrt(sigma2)
     return returns, sigma2
 
+def gas_multifractal(nsim:int, rng:np.random.Generator,
+    m0:float, psi_bar: float, k:int, f_initial:np.ndarray,
+    gamma_1: float, b:float, alpha:float
+    )->tuple[np.ndarray, np.ndarray]:
+    """
+    psi = log sigma2
+    gaussian innovation
+    """
+    draws = rng.standard_normal(size=nsim)
+    returns, sigma2 = gas_multifractal_paths(draws[None], m0, psi_bar, k, f_initial,
+        gamma_1, b, alpha)
+    return returns[0], sigma2[0]
+
+def _block(seed:np.random.SeedSequence, nsim:int, npaths:int, params:dict
+    )->tuple[np.ndarray, np.ndarray]:
+    draws = np.random.default_rng(seed).standard_normal(size=(npaths, nsim))
+    return gas_multifractal_paths(draws, **params)
+
+def simulate(nsim:int, npaths:int, params:dict, seed=None,
+    block_size:int = 1000, workers:int | None = 1, pool:ProcessPoolExecutor | None = None
+    )->tuple[np.ndarray, np.ndarray]:
+    """
+    Monte Carlo of npaths paths in blocks of block_size paths, every block
+    draws from its own stream spawned from np.random.SeedSequence(seed).
+    The draws depend only on (seed, nsim, npaths, block_size), so repeated calls
+    with different params use common random numbers.
+    params: keyword arguments of gas_multifractal_paths except draws
+    workers: processes simulating the blocks, 1 runs them in this process
+    pool: executor reused across calls instead of a new pool of workers processes
+    returns: returns and sigma2, (npaths, nsim)
+    """
+    nblocks = -(-npaths // block_size)
+    seeds = np.random.SeedSequence(seed).spawn(nblocks)
+    sizes = [min(block_size, npaths - i * block_size) for i in range(nblocks)]
+    if pool is not None:
+        results = list(pool.map(_block, seeds, [nsim] * nblocks, sizes, [params] * nblocks))
+    elif workers == 1:
+        results = [_block(sd, nsim, n, params) for sd, n in zip(seeds, sizes)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_block, seeds, [nsim] * nblocks, sizes, [params] * nblocks))
+    returns = np.concatenate([r[0] for r in results])
+    sigma2 = np.concatenate([r[1] for r in results])
+    return returns, sigma2
+
 if __name__ == '__main__':
     import matplotlib.pyplot as plt
     nsim = 1000
@@ -0,0 +1,126 @@
+"""
+Simulated method of moments for the score driven multifractal of gas_multifractal,
+calibrated to the scaling of the log IVs in bucket_matrix.
+
+Moments, for the empirical log IVs and the cumulated simulated returns:
+log variance of the daily increments, tau(q) of univariate_scaling.scaling and
+autocorrelations of |increments|^q.
+"""
+
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+
+# data/ and the sibling modules are found from this file, whatever the working directory
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(root, "2holder_est"))
+from gas_multifractal import simulate
+from univariate_scaling import scaling
+
+def _acf(X:np.ndarray, lags:np.ndarray)->np.ndarray:
+    """NaN-aware autocorrelations of the columns of X (T, ncol), (nlags, ncol)"""
+    Xc = X - np.nanmean(X, axis=0)
+    var = np.nanmean(Xc**2, axis=0)
+    return np.stack([np.nanmean(Xc[l:] * Xc[:-l], axis=0) / var for l in lags])
+
+def _moments(X:np.ndarray, qs:np.ndarray, acf_qs:np.ndarray, lags:np.ndarray,
+    minf:float, maxf:float)->np.ndarray:
+    """Moment vector of every column of the levels X (T, ncol), (ncol, nmoments)"""
+    inc = np.diff(X, axis=0)
+    log_var = np.log(np.nanmean(inc**2, axis=0))
+    holder = scaling(X, minf, maxf, qs)["holder"]
+    acf = [_acf(np.abs(inc)**q, lags).T for q in acf_qs]
+    return np.column_stack([log_var, holder] + acf)
+
+def _average(moments:np.ndarray)->np.ndarray:
+    """Mean over the columns of the finite moments, a lag beyond a short series gives -inf"""
+    return np.nanmean(np.where(np.isfinite(moments), moments, np.nan), axis=0)
+
+def empirical_moments(settings:dict, subfolder:str = "SPY", columns:list | None = None,
+    cache:bool = True)->np.ndarray:
+    """
+    Moments of the log IVs of bucket_matrix averaged over the buckets, computed once and
+    stored in data/<subfolder>/put/smm/<key>.npy, key hashing the input file and the settings
+    settings: qs, acf_qs, lags, minf and maxf of _moments
+    """
+    path = os.path.join(root, "data", subfolder, "put", "bucket_matrix.parquet")
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 24), b""):
+            h.update(chunk)
+    h.update(json.dumps([settings, columns], sort_keys=True, default=np.ndarray.tolist).encode())
+    cache_path = os.path.join(root, "data", subfolder, "put", "smm", h.hexdigest() + ".npy")
+    if cache and os.path.exists(cache_path):
+        return np.load(cache_path)
+    X = pd.read_parquet(path, columns=columns).to_numpy(dtype=float)
+    out = _average(_moments(X, **settings))
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    np.save(cache_path, out)
+    return out
+
+def _link(x:np.ndarray, k:int)->dict:
+    """(log sigma2 bar, m0 in (0, 2), alpha, lambda_1 > 0, b > 1) from an unconstrained vector"""
+    return {"psi_bar": x[0], "m0": 2.0 / (1.0 + np.exp(-x[1])), "alpha": x[2],
+        "gamma_1": np.exp(x[3]), "b": 1.0 + np.exp(x[4]), "k": k, "f_initial": np.zeros(k)}
+
+def _invlink(params:dict)->np.ndarray:
+    m0 = params["m0"] / 2.0
+    return np.array([params["psi_bar"], np.log(m0 / (1.0 - m0)), params["alpha"],
+        np.log(params["gamma_1"]), np.log(params["b"] - 1.0)])
+
+def fit(initial_guess:dict, k:int = 5, npaths:int = 200, nsim:int | None = None, seed=0,
+    W:np.ndarray | None = None, settings:dict | None = None, subfolder:str = "SPY",
+    workers:int | None = 1, maxsize:int = 4096, opt_options:dict | None = None)->dict:
+    """
+    Minimises (m_sim - m_emp)' W (m_sim - m_emp) with Nelder-Mead.
+    The empirical moments are computed once (and cached on disk, see empirical_moments).
+    The simulated moments are averaged over npaths paths simulated with the same
+    common random numbers at every evaluation, so the objective is a deterministic,
+    smooth function of the parameters, and every evaluation is memoised in an LRU
+    keyed by the parameter vector.
+    initial_guess: psi_bar, m0, alpha, gamma_1 and b
+    nsim: length of the simulated paths, defaults to the number of dates
+    W: weighting matrix, defaults to the identity
+    workers: processes simulating the paths, one pool serves all the evaluations
+    """
+    if settings is None:
+        settings = {"qs": np.arange(1, 9) / 2, "acf_qs": np.array([1.0, 2.0]),
+            "lags": np.array([1, 5, 21]), "minf": 1.0, "maxf": 126.0}
+    m_emp = empirical_moments(settings, subfolder)
+    if nsim is None:
+        path = os.path.join(root, "data", subfolder, "put", "bucket_matrix.parquet")
+        nsim = pd.read_parquet(path, columns=[]).shape[0]
+    if W is None: W = np.eye(m_emp.shape[0])
+
+    pool = None if workers == 1 else ProcessPoolExecutor(max_workers=workers)
+
+    @lru_cache(maxsize=maxsize)
+    def _simulated_moments(x:tuple)->np.ndarray:
+        returns, _ = simulate(nsim, npaths, _link(np.array(x), k), seed=seed, pool=pool)
+        return _average(_moments(np.cumsum(returns.T, axis=0), **settings))
+
+    def _criterion(x:np.ndarray)->float:
+        g = _simulated_moments(tuple(x)) - m_emp
+        return float(g @ W @ g) if np.all(np.isfinite(g)) else np.inf
+
+    try:
+        res = minimize(_criterion, _invlink(initial_guess), method="Nelder-Mead", options=opt_options)
+        moments_simulated = _simulated_moments(tuple(res.x))
+    finally:
+        if pool is not None: pool.shutdown()
+    return _link(res.x, k) | {
+        "moments_empirical": m_emp,
+        "moments_simulated": moments_simulated,
+        "objective": res.fun,
+        "niter": res.nit,
+        "is_converged": res.success,
+        "cache_info": _simulated_moments.cache_info()
+    }